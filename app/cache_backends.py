@@ -0,0 +1,323 @@
+"""
+Two-tier cache backend: a bounded in-process LRU/TTL cache (L1) in front of
+Django's ``RedisCache`` (L2).
+
+Reads are answered from L1 when possible and fill it on a Redis hit. Every
+write goes to Redis, drops the key from the local L1 and is broadcast on a
+Redis pub/sub channel, so the other worker processes drop it too. Writes of
+``L1_EXCLUDE`` keys, which are never in L1, are not broadcast. L1 entries
+also expire after ``L1_TIMEOUT`` seconds, which bounds staleness should a
+message be lost. Values returned from L1 are shared between callers and must
+not be mutated.
+
+OPTIONS (besides the ``RedisCache`` ones):
+
+    L1_MAX_ENTRIES   entries kept per process (default 1000)
+    L1_TIMEOUT       seconds an entry may be served from memory (default 5)
+    L1_EXCLUDE       glob patterns of keys always read from Redis, for values
+                     that must never be stale such as version counters and
+                     locks (default none)
+
+Hits and misses of both tiers are counted per process and added up in Redis
+every ``STATS_FLUSH_INTERVAL`` seconds; ``TwoTierCache.stats()`` returns the
+totals across all workers.
+"""
+
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache
+
+STATS_FLUSH_INTERVAL = 10
+TIERS = ("l1", "l2")
+CLEAR_ALL = "*"
+
+_MISSING = object()
+
+
+class LocalTier:
+    """Thread-safe LRU dict whose entries expire after ``timeout`` seconds"""
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Moves on every invalidation; a value read from Redis before an
+        # invalidation of any key is not stored
+        self.epoch = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _MISSING
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, epoch):
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def discard(self, keys):
+        with self._lock:
+            self.epoch += 1
+            if CLEAR_ALL in keys:
+                self._data.clear()
+            for key in keys:
+                self._data.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not _MISSING
+
+
+class TierStats:
+    """Hit and miss counters of one process, flushed to a Redis hash"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._flushed_at = time.monotonic()
+
+    def count(self, tier, hits=0, misses=0):
+        with self._lock:
+            for name, amount in ((f"{tier}_hits", hits), (f"{tier}_misses", misses)):
+                if amount:
+                    self._counts[name] = self._counts.get(name, 0) + amount
+
+    def due(self):
+        return time.monotonic() - self._flushed_at >= STATS_FLUSH_INTERVAL
+
+    def flush(self, client, stats_key):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            self._flushed_at = time.monotonic()
+        if counts:
+            pipeline = client.pipeline()
+            for name, amount in counts.items():
+                pipeline.hincrby(stats_key, name, amount)
+            pipeline.execute()
+
+
+# Django creates a cache backend per thread; the local tier, the stats and the
+# subscription are shared by all threads of a process
+_process_state = {}
+_process_state_lock = threading.Lock()
+
+
+class _ProcessState:
+    def __init__(self, max_entries, timeout):
+        self.pid = os.getpid()
+        self.origin = uuid.uuid4().hex
+        self.local = LocalTier(max_entries, timeout)
+        self.stats = TierStats()
+        self.subscription = None
+
+
+class TwoTierCache(RedisCache):
+    def __init__(self, server, params):
+        options = dict(params.get("OPTIONS", {}))
+        self.l1_max_entries = options.pop("L1_MAX_ENTRIES", 1000)
+        self.l1_timeout = options.pop("L1_TIMEOUT", 5)
+        exclude = options.pop("L1_EXCLUDE", ())
+        self.l1_exclude = (
+            re.compile("|".join(fnmatch.translate(pattern) for pattern in exclude))
+            if exclude
+            else None
+        )
+        super().__init__(server, {**params, "OPTIONS": options})
+        self.channel = self.make_key("cache-invalidation")
+        self.stats_key = self.make_key("cache-stats")
+        self._state_id = (tuple(self._servers), self.key_prefix)
+
+    @property
+    def _state(self):
+        state = _process_state.get(self._state_id)
+        # Forked workers start over: threads don't survive a fork
+        if state is None or state.pid != os.getpid():
+            with _process_state_lock:
+                state = _process_state.get(self._state_id)
+                if state is None or state.pid != os.getpid():
+                    state = _ProcessState(self.l1_max_entries, self.l1_timeout)
+                    _process_state[self._state_id] = state
+        if state.subscription is None or not state.subscription.is_alive():
+            self._subscribe(state)
+        if state.stats.due():
+            state.stats.flush(self._cache.get_client(write=True), self.stats_key)
+        return state
+
+    def _subscribe(self, state):
+        with _process_state_lock:
+            if state.subscription is not None and state.subscription.is_alive():
+                return
+
+            def on_message(message):
+                payload = json.loads(message["data"])
+                # Our own writes were dropped locally already
+                if payload["origin"] != state.origin:
+                    state.local.discard(payload["keys"])
+
+            pubsub = self._cache.get_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: on_message})
+            state.subscription = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _invalidate(self, keys, version=None):
+        keys = [
+            self.make_and_validate_key(key, version=version)
+            for key in keys
+            if self._in_l1(key)
+        ]
+        if keys:
+            self._discard(keys)
+
+    def _discard(self, keys):
+        state = self._state
+        state.local.discard(keys)
+        self._cache.get_client(write=True).publish(
+            self.channel, json.dumps({"origin": state.origin, "keys": keys})
+        )
+
+    @property
+    def local(self):
+        return self._state.local
+
+    def _in_l1(self, key):
+        return self.l1_exclude is None or not self.l1_exclude.match(key)
+
+    def get(self, key, default=None, version=None):
+        if not self._in_l1(key):
+            value = super().get(key, _MISSING, version=version)
+            hit = value is not _MISSING
+            self._state.stats.count("l2", hits=int(hit), misses=int(not hit))
+            return value if hit else default
+
+        key = self.make_and_validate_key(key, version=version)
+        state = self._state
+        value = state.local.get(key)
+        if value is not _MISSING:
+            state.stats.count("l1", hits=1)
+            return value
+
+        epoch = state.local.epoch
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            state.stats.count("l1", misses=1)
+            state.stats.count("l2", misses=1)
+            return default
+        state.local.set(key, value, epoch)
+        state.stats.count("l1", misses=1)
+        state.stats.count("l2", hits=1)
+        return value
+
+    def get_many(self, keys, version=None):
+        key_map = {
+            self.make_and_validate_key(key, version=version): key for key in keys
+        }
+        state = self._state
+        found = {}
+        for key, original in key_map.items():
+            if self._in_l1(original):
+                value = state.local.get(key)
+                if value is not _MISSING:
+                    found[key] = value
+        missing = [key for key in key_map if key not in found]
+        state.stats.count(
+            "l1",
+            hits=len(found),
+            misses=sum(self._in_l1(key_map[key]) for key in missing),
+        )
+
+        if missing:
+            epoch = state.local.epoch
+            fetched = self._cache.get_many(missing)
+            for key, value in fetched.items():
+                if self._in_l1(key_map[key]):
+                    state.local.set(key, value, epoch)
+            found.update(fetched)
+            state.stats.count(
+                "l2", hits=len(fetched), misses=len(missing) - len(fetched)
+            )
+        return {key_map[key]: value for key, value in found.items()}
+
+    def has_key(self, key, version=None):
+        if (
+            self._in_l1(key)
+            and self.make_and_validate_key(key, version=version) in self._state.local
+        ):
+            return True
+        return super().has_key(key, version=version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = super().add(key, value, timeout, version=version)
+        if added:
+            self._invalidate([key], version=version)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version=version)
+        self._invalidate([key], version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        touched = super().touch(key, timeout, version=version)
+        self._invalidate([key], version=version)
+        return touched
+
+    def delete(self, key, version=None):
+        deleted = super().delete(key, version=version)
+        self._invalidate([key], version=version)
+        return deleted
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version=version)
+        self._invalidate([key], version=version)
+        return value
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        result = super().set_many(data, timeout, version=version)
+        self._invalidate(data, version=version)
+        return result
+
+    def delete_many(self, keys, version=None):
+        super().delete_many(keys, version=version)
+        self._invalidate(keys, version=version)
+
+    def clear(self):
+        result = super().clear()
+        self._discard([CLEAR_ALL])
+        return result
+
+    def stats(self):
+        """Hits, misses and hit rate of each tier across all workers"""
+        client = self._cache.get_client(write=True)
+        self._state.stats.flush(client, self.stats_key)
+        totals = {
+            name.decode(): int(amount)
+            for name, amount in client.hgetall(self.stats_key).items()
+        }
+        result = {}
+        for tier in TIERS:
+            hits = totals.get(f"{tier}_hits", 0)
+            misses = totals.get(f"{tier}_misses", 0)
+            lookups = hits + misses
+            result[tier] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / lookups if lookups else None,
+            }
+        return result
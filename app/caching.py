@@ -0,0 +1,205 @@
+"""
+Generation-based cache invalidation.
+
+Cached entries are keyed by the current generation of every tag they depend
+on: a thread, a list or ``AUTHORS``. Invalidating a tag increments its
+generation, so all keys built from the old value are never read again and
+expire by their TTL. There is no need to know which keys exist, and one
+write drops any number of them.
+
+Tags are bumped from the signals in ``app.signals`` on every save and delete
+of ``Comment`` and ``CommentAttachment``. Authors' names and emails are part
+of every rendered comment, so all cached documents also depend on
+``AUTHORS``, which a change to them bumps once instead of every thread the
+user wrote in. A new reply bumps ``thread_tag`` but not ``thread_content_tag``,
+so append-aware caches (``app.thread_cache``) keep their entries and patch
+them instead.
+
+``cached`` stores values under a stable key together with the generations
+they were computed from, and protects the computation against stampedes:
+only the process holding the key's lock recomputes, everybody else keeps
+being served the stale value meanwhile, and entries are refreshed a bit
+before they expire with a probability that grows towards expiry (XFetch).
+"""
+
+import math
+import random
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.db import transaction
+
+# TTL for generation-keyed entries; invalidation does not depend on it
+CACHE_TIMEOUT = 60 * 60
+# How long an expired or invalidated entry may still be served while it is
+# being recomputed
+STALE_TIMEOUT = 60 * 5
+# Upper bound for one recomputation; the lock is dropped after it
+LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.05
+
+GENERATION_KEY = "generation:{}"
+# When a tag was last invalidated, as a UNIX timestamp
+MODIFIED_KEY = "modified:{}"
+
+
+def thread_tag(thread_id):
+    return f"thread:{thread_id}"
+
+
+def thread_content_tag(thread_id):
+    """Existing comments of a thread; unlike thread_tag, new replies keep it"""
+    return f"thread-content:{thread_id}"
+
+
+def list_tag(name):
+    return f"list:{name}"
+
+
+# Top-level comments with their whole threads (changes with every comment)
+COMMENTS_LIST = list_tag("comments")
+# Top-level comments only (changes when a root comment changes)
+PREVIEW_LIST = list_tag("preview")
+# Usernames and emails shown with comments (changes when a user renames)
+AUTHORS = "authors"
+
+
+def _read_generations(tags, extra_keys=()):
+    """Generations of ``tags`` and the values of ``extra_keys``, one round trip"""
+    keys = [GENERATION_KEY.format(tag) for tag in tags]
+    found = cache.get_many([*keys, *extra_keys])
+    missing = [key for key in keys if key not in found]
+    if missing:
+        # Generations start from the clock, so a generation lost to eviction
+        # never brings back entries cached under an earlier value
+        now = time.time_ns()
+        for key in missing:
+            cache.add(key, now, timeout=None)
+        found.update(cache.get_many(missing))
+    return [found[key] for key in keys], found
+
+
+def get_generations(*tags):
+    """Current generation of every tag, with a single cache round trip"""
+    if not tags:
+        return []
+    return _read_generations(tags)[0]
+
+
+def get_validators(*tags):
+    """
+    Current generation of every tag and when any of them last changed.
+
+    A tag with no recorded change time counts as changed now, so it can only
+    make a conditional request fail.
+    """
+    modified_keys = [MODIFIED_KEY.format(tag) for tag in tags]
+    generations, found = _read_generations(tags, modified_keys)
+    now = time.time()
+    return generations, max(found.get(key, now) for key in modified_keys)
+
+
+def _bump(tags):
+    now = time.time()
+    for tag in tags:
+        try:
+            cache.incr(GENERATION_KEY.format(tag))
+        except ValueError:
+            pass  # Never read, so nothing is cached under it
+        cache.set(MODIFIED_KEY.format(tag), now, timeout=None)
+
+
+def invalidate(*tags):
+    """
+    Drop every entry that depends on one of ``tags``.
+
+    Bumps now, so the rest of this request sees fresh data, and once more on
+    commit: a reader that fetched the old rows between the two has cached
+    them under the intermediate generation.
+    """
+    _bump(tags)
+    transaction.on_commit(lambda: _bump(tags))
+
+
+@contextmanager
+def locked(key):
+    """Whether this process holds the lock for recomputing or writing ``key``"""
+    lock_key = f"{key}:lock"
+    acquired = cache.add(lock_key, True, LOCK_TIMEOUT)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def _version(tags):
+    return ".".join(str(generation) for generation in get_generations(*tags))
+
+
+def _refresh_early(entry, beta):
+    """XFetch: recompute early, more likely the closer and slower it is"""
+    gap = -entry["delta"] * beta * math.log(1.0 - random.random())
+    return time.time() + gap >= entry["expires"]
+
+
+def store(key, value, version, timeout=CACHE_TIMEOUT, delta=0.0):
+    entry = {
+        "value": value,
+        "version": version,
+        "expires": time.time() + timeout,
+        "delta": delta,
+    }
+    cache.set(key, entry, timeout + STALE_TIMEOUT)
+
+
+def get_entry(key, tags=()):
+    """
+    The raw entry under ``key`` and the current version of ``tags``.
+
+    The entry is fresh when ``entry["version"] == version``.
+    """
+    return cache.get(key), _version(tags)
+
+
+def refresh(key, compute, tags=(), timeout=CACHE_TIMEOUT):
+    """Compute and store the value of ``key`` unconditionally"""
+    # Version first: a change made while computing makes the result stale
+    version = _version(tags)
+    start = time.monotonic()
+    value = compute()
+    store(key, value, version, timeout, delta=time.monotonic() - start)
+    return value
+
+
+def cached(key, compute, tags=(), timeout=CACHE_TIMEOUT, beta=1.0):
+    """
+    Value of ``key``, computed with ``compute()`` when missing or stale.
+
+    ``tags`` invalidate the value, ``timeout`` expires it. At most one process
+    recomputes a key at a time; others get the stale value, or wait for the
+    new one when there is none. ``beta`` > 1 favours earlier refreshes.
+    """
+    entry, version = get_entry(key, tags)
+    if (
+        entry is not None
+        and entry["version"] == version
+        and not _refresh_early(entry, beta)
+    ):
+        return entry["value"]
+
+    with locked(key) as acquired:
+        if acquired:
+            return refresh(key, compute, tags, timeout)
+    if entry is not None:
+        return entry["value"]
+
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline and cache.get(f"{key}:lock"):
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["value"]
+    # The holder failed or timed out
+    return refresh(key, compute, tags, timeout)
@@ -0,0 +1,82 @@
+"""
+ETag and Last-Modified for comment GETs, for use with Django's ``condition``.
+
+Validators come from the cache generations in ``app.caching``: the ETag
+hashes the generation of the list or thread together with the request URL
+and the negotiated format, and Last-Modified is the last time the list or
+thread was invalidated, which is the newest ``updated_at`` (or reply
+``created_at``) in it. A request whose validators match gets a 304 without a
+database query or any serialization.
+
+Last-Modified has one-second resolution, so clients should prefer ETags.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timezone
+
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+
+from app.caching import AUTHORS, COMMENTS_LIST, get_validators, thread_tag
+from app.threads import cached_thread_id
+
+
+def _validators(request, tags):
+    # condition() asks for the ETag and Last-Modified separately
+    if not hasattr(request, "_comment_validators"):
+        generations, modified = get_validators(*tags)
+        fingerprint = json.dumps(
+            [
+                generations,
+                request.build_absolute_uri(),
+                getattr(request, "accepted_media_type", None),
+            ]
+        )
+        request._comment_validators = (
+            hashlib.sha1(fingerprint.encode()).hexdigest(),
+            datetime.fromtimestamp(modified, tz=timezone.utc),
+        )
+    return request._comment_validators
+
+
+def _thread_tags(pk):
+    thread_id = cached_thread_id(pk)
+    return None if thread_id is None else [thread_tag(thread_id), AUTHORS]
+
+
+def _list_validator(index):
+    def validator(request, *args, **kwargs):
+        return _validators(request, [COMMENTS_LIST, AUTHORS])[index]
+
+    return validator
+
+
+def _detail_validator(index):
+    def validator(request, pk, *args, **kwargs):
+        tags = _thread_tags(pk)
+        # Unknown comment: no validators, the view answers 404
+        return None if tags is None else _validators(request, tags)[index]
+
+    return validator
+
+
+# The body and the ETag depend on the negotiated format, 304s included
+comment_list_condition = method_decorator(
+    [
+        vary_on_headers("Accept"),
+        condition(etag_func=_list_validator(0), last_modified_func=_list_validator(1)),
+    ],
+    name="get",
+)
+
+comment_detail_condition = method_decorator(
+    [
+        vary_on_headers("Accept"),
+        condition(
+            etag_func=_detail_validator(0), last_modified_func=_detail_validator(1)
+        ),
+    ],
+    name="get",
+)
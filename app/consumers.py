@@ -1,7 +1,10 @@
-import json
-
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from app.renderers import dumps, packb
+
+# Subprotocol for MessagePack binary frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "msgpack"
+
 
 class ReplyConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -14,15 +17,34 @@ class ReplyConsumer(AsyncWebsocketConsumer):
 
         await self.channel_layer.group_add(self.comment_name, self.channel_name)
 
-        await self.accept()
+        self.binary = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.binary else None)
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.comment_name, self.channel_name)
 
     async def new_reply(self, event):
         """
-        Отправляет новый ответ всем подключенным клиентам
+        Отправляет новый ответ всем подключенным клиентам: JSON-текстом
+        или бинарным кадром MessagePack для подпротокола msgpack
+        """
+        await self._send_event("new_reply", event["reply"])
+
+    async def attachment_ready(self, event):
+        """
+        Сообщает, что вложение обработано и загружено
         """
-        reply_data = event["reply"]
+        await self._send_event("attachment_ready", event["attachment"])
 
-        await self.send(text_data=json.dumps({"type": "new_reply", "data": reply_data}))
+    async def attachment_failed(self, event):
+        """
+        Сообщает, что вложение не удалось обработать
+        """
+        await self._send_event("attachment_failed", event["attachment"])
+
+    async def _send_event(self, event_type, data):
+        message = {"type": event_type, "data": data}
+        if self.binary:
+            await self.send(bytes_data=packb(message))
+        else:
+            await self.send(text_data=dumps(message).decode())
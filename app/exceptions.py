@@ -1,2 +1,24 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
 class EmailSendingError(Exception):
     pass
+
+
+class ThreadDocumentBusy(Exception):
+    pass
+
+
+class RecaptchaUnavailable(Exception):
+    pass
+
+
+class AttachmentStorageError(Exception):
+    pass
+
+
+class SyncCursorExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = "Sync cursor expired, start over without one"
+    default_code = "cursor_expired"
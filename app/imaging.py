@@ -0,0 +1,58 @@
+"""
+Image variants for attachments, rendered by the worker (``app.media``).
+
+This module works on file paths and plain values and imports nothing from
+Django.
+"""
+
+import os
+import tempfile
+
+from PIL import Image
+
+# (name, bounding box, format), smallest first
+VARIANTS = [
+    ("thumbnail", (320, 240), "WEBP"),
+    ("medium", (1024, 768), "WEBP"),
+]
+
+
+def render_variants(path, directory, variants=VARIANTS):
+    """
+    Render ``variants`` of the image at ``path`` to files in ``directory``.
+
+    Returns a ``{"name", "path", "width", "height", "format"}`` dict per
+    rendered file, smallest first. Images are never enlarged, so a variant
+    that would come out the same size as the previous one is skipped.
+    """
+    rendered = []
+    with Image.open(path) as image:
+        # JPEG only: decode at the smallest scale the largest variant allows
+        image.draft(image.mode, variants[-1][1])
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+        for name, box, image_format in variants:
+            variant = image.copy()
+            variant.thumbnail(box)
+            if rendered and variant.size == (
+                rendered[-1]["width"],
+                rendered[-1]["height"],
+            ):
+                continue
+            fd, variant_path = tempfile.mkstemp(
+                dir=directory, suffix="." + image_format.lower()
+            )
+            with os.fdopen(fd, "wb") as output:
+                variant.save(output, format=image_format)
+            rendered.append(
+                {
+                    "name": name,
+                    "path": variant_path,
+                    "width": variant.width,
+                    "height": variant.height,
+                    "format": image_format.lower(),
+                }
+            )
+    return rendered
@@ -0,0 +1,105 @@
+import io
+import json
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from app.parsers import ORJSONParser
+from app.renderers import ORJSONRenderer, dumps
+
+
+def _comment(pk, created_at, depth, replies, max_depth):
+    """A comment shaped like CommentSerializer output"""
+    children = []
+    if depth < max_depth:
+        for i in range(replies):
+            children.append(
+                _comment(
+                    pk * (replies + 1) + i + 1,
+                    created_at + timedelta(minutes=i + 1),
+                    depth + 1,
+                    replies,
+                    max_depth,
+                )
+            )
+    timestamp = created_at.isoformat().replace("+00:00", "Z")
+    return {
+        "id": pk,
+        "user": {"id": pk % 50, "username": f"user{pk % 50}", "email": "u@ex.com"},
+        "text": "Lorem ipsum <i>dolor</i> sit amet, <strong>consectetur</strong> "
+        "adipiscing elit — ünïcödé. " * 4,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "reply": None if depth == 0 else pk // (replies + 1),
+        "replies": children,
+        "replies_count": len(children),
+        "replies_cursor": None,
+        "descendant_count": sum(c["descendant_count"] + 1 for c in children),
+        "last_activity_at": timestamp,
+        "attachments": [
+            {
+                "id": pk,
+                "file": f"https://res.cloudinary.com/demo/image/upload/{pk}.jpg",
+                "media_type": "image",
+            }
+        ]
+        * (pk % 3 == 0),
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare the stdlib and orjson JSON renderers and parsers on comment pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=25)
+        parser.add_argument("--replies", type=int, default=3)
+        parser.add_argument("--depth", type=int, default=3)
+        parser.add_argument("--iterations", type=int, default=50)
+
+    def handle(self, *args, **options):
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        page = {
+            "count": options["threads"],
+            "next": None,
+            "previous": None,
+            "results": [
+                _comment(i + 1, start, 0, options["replies"], options["depth"])
+                for i in range(options["threads"])
+            ],
+        }
+        body = JSONRenderer().render(page)
+        reply = page["results"][0]["replies"][0] if options["depth"] else page
+        message = {"type": "new_reply", "data": reply}
+        self.stdout.write(
+            f"Payload: {len(body)} bytes, broadcast {len(dumps(message))}"
+        )
+
+        cases = [
+            (
+                "render",
+                lambda: JSONRenderer().render(page),
+                lambda: ORJSONRenderer().render(page),
+            ),
+            (
+                "parse",
+                lambda: JSONParser().parse(io.BytesIO(body)),
+                lambda: ORJSONParser().parse(io.BytesIO(body)),
+            ),
+            (
+                "broadcast",
+                lambda: json.dumps(message),
+                lambda: dumps(message).decode(),
+            ),
+        ]
+        iterations = options["iterations"]
+        for name, stdlib, fast in cases:
+            stdlib_time = timeit.timeit(stdlib, number=iterations) / iterations
+            fast_time = timeit.timeit(fast, number=iterations) / iterations
+            self.stdout.write(
+                f"{name:<10} stdlib {stdlib_time * 1000:8.3f} ms"
+                f"  orjson {fast_time * 1000:8.3f} ms"
+                f"  x{stdlib_time / fast_time:.1f}"
+            )
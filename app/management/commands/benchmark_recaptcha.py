@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from app.recaptcha import GoogleRecaptchaVerifier
+
+
+class StubSiteverifyHandler(BaseHTTPRequestHandler):
+    """Answers every siteverify request with success after ``latency`` seconds"""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    body = b'{"success": true}'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure reCAPTCHA verification throughput against a local stub server "
+        "with simulated latency, pooled and with a connection per request"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--latency", type=float, default=50, help="ms")
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubSiteverifyHandler)
+        server.daemon_threads = True
+        server.latency = options["latency"] / 1000
+        server.lock = threading.Lock()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/siteverify"
+
+        verifier = GoogleRecaptchaVerifier(url=url, secret="secret", timeout=10)
+
+        def unpooled(token):
+            return requests.post(
+                url, data={"secret": "secret", "response": token}, timeout=10
+            ).json()
+
+        try:
+            for name, verify in (("pooled", verifier.verify), ("unpooled", unpooled)):
+                server.connections = 0
+                start = time.perf_counter()
+                with ThreadPoolExecutor(options["concurrency"]) as pool:
+                    results = list(
+                        pool.map(verify, (str(i) for i in range(options["requests"])))
+                    )
+                elapsed = time.perf_counter() - start
+                assert all(result["success"] for result in results)
+                self.stdout.write(
+                    f"{name:<9} {len(results) / elapsed:8.1f} req/s"
+                    f"  {server.connections} connections"
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,303 @@
+"""
+Attachment processing, run by the ``process_comment_attachment`` task.
+
+The comment POST only validates the files and stages them under MEDIA_ROOT
+with their attachments ``pending``. The worker then shrinks images to
+thumbnail size, stores the result (``app.storage``), marks the attachment
+``ready`` (or ``failed``) and tells the thread's WebSocket group, so request
+latency no longer depends on file sizes or on the storage.
+
+Files are addressed by their SHA-256: once a file has been uploaded, its URL
+is kept in ``AttachmentBlob`` and later attachments with the same content
+are ready at once, with no processing or upload.
+
+Images keep their original and get the sizes and formats in
+``app.imaging.VARIANTS``, listed smallest first in ``variants`` so clients
+can fetch the smallest one that fits; ``file`` is the smallest of them.
+Encoding runs in the worker, whose prefork pool is the process pool that
+keeps it off the web processes.
+
+No step holds a whole file in memory. Uploads larger than
+FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to temporary files by Django;
+validation reads only the first bytes (``sniff_format``) and the image
+header (``image_size``); hashing, staging and storing copy in chunks; and
+variants are written to temporary files, with JPEGs decoded at a reduced
+scale (``Image.draft``). Peak Python memory per upload is therefore about
+one 64KB chunk, whatever the size of the file; Pillow's pixel buffer,
+outside the Python heap, is the reduced image: at least 1/2 of each side
+smaller for large JPEGs, the full frame for PNG and GIF, whose formats
+can't be decoded at a smaller scale.
+"""
+
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db.models import BigIntegerField, F, Sum
+from PIL import Image
+
+from app import imaging
+from app.models import AttachmentBlob, CommentAttachment
+from app.storage import get_storage
+
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif"]
+# Files of one comment written to staging at the same time
+STAGING_WORKERS = 4
+# Larger images are rejected by their header, before anything is decoded
+MAX_IMAGE_PIXELS = 40_000_000
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+]
+
+
+def media_type_for(name):
+    ext = os.path.splitext(name)[1].lower()
+    return "image" if ext in IMAGE_EXTENSIONS else "file"
+
+
+def file_digest(file):
+    """SHA-256 of an uploaded file, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def sniff_format(file):
+    """Image format of ``file`` from its magic number, or None"""
+    header = file.read(8)
+    file.seek(0)
+    for magic, image_format in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return image_format
+    return None
+
+
+def image_size(file, image_format):
+    """
+    ``(width, height)`` of an image, read from its header without decoding
+    the pixels. Raises ValueError when the header can't be parsed.
+    """
+    try:
+        with Image.open(file, formats=[image_format]) as image:
+            return image.size
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ValueError(str(exc)) from exc
+    finally:
+        file.seek(0)
+
+
+def _reused(counts):
+    for blob_id, count in counts.items():
+        AttachmentBlob.objects.filter(pk=blob_id).update(
+            reuse_count=F("reuse_count") + count
+        )
+
+
+def stage_attachments(comment, uploads):
+    """
+    Unsaved attachments of ``comment`` for ``uploads``, ``(file, sha256)``
+    pairs.
+
+    Files already uploaded once are ready with the stored URL. The others
+    are pending, with their files written to the staging storage
+    concurrently: either every file is written or none is left behind and
+    the first error is raised.
+    """
+    blobs = AttachmentBlob.objects.in_bulk(
+        {digest for _, digest in uploads}, field_name="sha256"
+    )
+    attachments, staged, reuses = [], [], {}
+    for file, digest in uploads:
+        media_type = media_type_for(file.name)
+        blob = blobs.get(digest)
+        if blob is not None and blob.media_type == media_type:
+            attachment = CommentAttachment(
+                comment=comment,
+                media_type=media_type,
+                sha256=digest,
+                file=blob.file,
+                variants=blob.variants,
+                status=CommentAttachment.Status.READY,
+            )
+            reuses[blob.id] = reuses.get(blob.id, 0) + 1
+        else:
+            attachment = CommentAttachment(
+                comment=comment, media_type=media_type, sha256=digest
+            )
+            staged.append((attachment, file))
+        attachments.append(attachment)
+    _reused(reuses)
+    if not staged:
+        return attachments
+
+    def stage(attachment, file):
+        attachment.staged_file.save(file.name, file, save=False)
+
+    with ThreadPoolExecutor(min(STAGING_WORKERS, len(staged))) as pool:
+        futures = [pool.submit(stage, *item) for item in staged]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        for attachment, _ in staged:
+            if attachment.staged_file:
+                attachment.staged_file.delete(save=False)
+        raise errors[0]
+    return attachments
+
+
+def store_variants(staged, name):
+    """
+    Store the original and the rendered variants of the staged image
+    ``staged``, listed smallest first for ``CommentAttachment.variants``.
+    """
+    storage = get_storage()
+    stem = os.path.splitext(name)[0]
+    with tempfile.TemporaryDirectory() as directory:
+        variants = []
+        for variant in imaging.render_variants(staged.path, directory):
+            with open(variant.pop("path"), "rb") as file:
+                variant["url"] = storage.save(
+                    file, f"{stem}-{variant['name']}.{variant['format']}"
+                )
+            variants.append(variant)
+
+    with staged.open("rb") as file:
+        image_format = sniff_format(file)
+        width, height = image_size(file, image_format)
+        variants.append(
+            {
+                "name": "original",
+                "width": width,
+                "height": height,
+                "format": image_format.lower(),
+                "url": storage.save(file, name),
+            }
+        )
+    return variants
+
+
+def serialize_attachment(attachment):
+    return {
+        "id": attachment.id,
+        "comment": attachment.comment_id,
+        "file": attachment.file,
+        "media_type": attachment.media_type,
+        "status": attachment.status,
+        "variants": attachment.variants,
+    }
+
+
+def _notify(attachment):
+    # The group new_reply events go to
+    thread_id = attachment.comment.thread_id
+    event = (
+        "attachment_ready"
+        if attachment.status == CommentAttachment.Status.READY
+        else "attachment_failed"
+    )
+    async_to_sync(get_channel_layer().group_send)(
+        f"comment_{thread_id}",
+        {"type": event, "attachment": serialize_attachment(attachment)},
+    )
+
+
+def _finish(attachment, status, url="", variants=()):
+    attachment.status = status
+    attachment.file = url
+    attachment.variants = list(variants)
+    staged = attachment.staged_file
+    attachment.staged_file = ""
+    attachment.save(update_fields=["status", "file", "variants", "staged_file"])
+    if staged:
+        staged.storage.delete(staged.name)
+    _notify(attachment)
+
+
+def process_attachment(attachment_id):
+    """
+    Resize and upload a pending attachment.
+
+    Returns False when it doesn't exist or is no longer pending. Storage
+    errors propagate, so the task can retry; ``fail_attachment`` gives up.
+    """
+    attachment = (
+        CommentAttachment.objects.select_related("comment")
+        .filter(pk=attachment_id, status=CommentAttachment.Status.PENDING)
+        .first()
+    )
+    if attachment is None:
+        return False
+
+    # The same file may have been uploaded since it was staged
+    blob = (
+        AttachmentBlob.objects.filter(
+            sha256=attachment.sha256, media_type=attachment.media_type
+        ).first()
+        if attachment.sha256
+        else None
+    )
+    if blob is not None:
+        _reused({blob.id: 1})
+        _finish(attachment, CommentAttachment.Status.READY, blob.file, blob.variants)
+        return True
+
+    name = os.path.basename(attachment.staged_file.name)
+    try:
+        size = attachment.staged_file.size
+        if attachment.media_type == "image":
+            variants = store_variants(attachment.staged_file, name)
+            url = variants[0]["url"]
+        else:
+            variants = []
+            with attachment.staged_file.open("rb") as staged:
+                url = get_storage().save(staged, name)
+    except (OSError, ValueError):
+        # Missing staged file or broken image: retrying won't help
+        _finish(attachment, CommentAttachment.Status.FAILED)
+        return True
+
+    if attachment.sha256:
+        AttachmentBlob.objects.get_or_create(
+            sha256=attachment.sha256,
+            defaults={
+                "file": url,
+                "media_type": attachment.media_type,
+                "size": size,
+                "variants": variants,
+            },
+        )
+    _finish(attachment, CommentAttachment.Status.READY, url, variants)
+    return True
+
+
+def fail_attachment(attachment_id):
+    """Mark a pending attachment failed, after its uploads were retried"""
+    attachment = (
+        CommentAttachment.objects.select_related("comment")
+        .filter(pk=attachment_id, status=CommentAttachment.Status.PENDING)
+        .first()
+    )
+    if attachment is not None:
+        _finish(attachment, CommentAttachment.Status.FAILED)
+
+
+def deduplication_stats():
+    """Uploads skipped because the same file was already stored"""
+    totals = AttachmentBlob.objects.aggregate(
+        reused=Sum("reuse_count", default=0),
+        bytes_saved=Sum(
+            F("size") * F("reuse_count"), output_field=BigIntegerField(), default=0
+        ),
+    )
+    return {
+        "stored_files": AttachmentBlob.objects.count(),
+        "reused_uploads": totals["reused"],
+        "bytes_saved": totals["bytes_saved"],
+    }
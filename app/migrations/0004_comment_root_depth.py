@@ -0,0 +1,63 @@
+# Generated by Django 5.2.8 on 2026-10-17 01:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_threads(apps, schema_editor):
+    """Walk every thread level by level and store its root id and depth"""
+    Comment = apps.get_model("app", "Comment")
+
+    level = {
+        pk: (None, 0)
+        for pk in Comment.objects.filter(reply__isnull=True).values_list(
+            "pk", flat=True
+        )
+    }
+    seen = set(level)
+
+    while level:
+        parent_ids = list(level)
+        next_level = {}
+        for start in range(0, len(parent_ids), 500):
+            chunk = parent_ids[start : start + 500]
+            for pk, reply_id in Comment.objects.filter(reply_id__in=chunk).values_list(
+                "pk", "reply_id"
+            ):
+                if pk in seen:
+                    continue
+                parent_root, parent_depth = level[reply_id]
+                next_level[pk] = (parent_root or reply_id, parent_depth + 1)
+                seen.add(pk)
+
+        groups = {}
+        for pk, values in next_level.items():
+            groups.setdefault(values, []).append(pk)
+        for (root_id, depth), pks in groups.items():
+            for start in range(0, len(pks), 500):
+                Comment.objects.filter(pk__in=pks[start : start + 500]).update(
+                    root_id=root_id, depth=depth
+                )
+
+        level = next_level
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_alter_commentattachment_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='root',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thread_comments', to='app.comment'),
+        ),
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.8 on 2026-10-17 01:20
+
+from django.db import migrations, models
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+
+def backfill_paths(apps, schema_editor):
+    """Build paths top-down, one UPDATE per thread depth"""
+    Comment = apps.get_model("app", "Comment")
+
+    segment = LPad(Cast("id", CharField()), 10, Value("0"))
+    Comment.objects.filter(depth=0).update(path=segment)
+
+    max_depth = Comment.objects.aggregate(models.Max("depth"))["depth__max"] or 0
+    for depth in range(1, max_depth + 1):
+        parent_path = Comment.objects.filter(pk=OuterRef("reply_id")).values("path")[:1]
+        Comment.objects.filter(depth=depth).update(
+            path=Concat(Subquery(parent_path), segment, output_field=CharField())
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_comment_root_depth'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(default='', max_length=2550),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['path'], name='comment_path_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['root', 'path'], name='comment_thread_path_idx'),
+        ),
+    ]
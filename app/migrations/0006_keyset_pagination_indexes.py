@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-17 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_comment_path'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('reply__isnull', True)), fields=['-created_at', '-id'], name='comment_toplevel_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('reply__isnull', True)), fields=['user', 'id'], name='comment_toplevel_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email', 'id'], name='user_email_id_idx'),
+        ),
+    ]
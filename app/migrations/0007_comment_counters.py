@@ -0,0 +1,57 @@
+# Generated by Django 5.2.8 on 2026-10-17 01:25
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, Func, OuterRef, Subquery
+
+
+def backfill_counters(apps, schema_editor):
+    Comment = apps.get_model("app", "Comment")
+
+    def aggregate(function, field, **filters):
+        return Subquery(
+            Comment.objects.filter(**filters)
+            .order_by()
+            .annotate(value=Func(F(field), function=function))
+            .values("value")
+        )
+
+    Comment.objects.update(
+        reply_count=aggregate("COUNT", "pk", reply=OuterRef("pk")),
+        descendant_count=aggregate(
+            "COUNT", "pk", path__startswith=OuterRef("path"), depth__gt=OuterRef("depth")
+        ),
+        last_activity_at=aggregate(
+            "MAX", "created_at", path__startswith=OuterRef("path")
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(('reply__isnull', True)), fields=['-last_activity_at', '-id'], name='comment_toplevel_activity_idx'),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:10
+
+from django.contrib.postgres import operations
+from django.db import migrations
+
+POSTGRES_FORWARD = [
+    "ALTER TABLE app_comment ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED",
+    "CREATE INDEX comment_search_vector_idx ON app_comment USING GIN (search_vector)",
+    # Django's icontains compiles to UPPER(column) LIKE UPPER(%s)
+    "CREATE INDEX user_username_trgm_idx ON app_user USING GIN (UPPER(username) gin_trgm_ops)",
+    "CREATE INDEX user_email_trgm_idx ON app_user USING GIN (UPPER(email) gin_trgm_ops)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS user_email_trgm_idx",
+    "DROP INDEX IF EXISTS user_username_trgm_idx",
+    "DROP INDEX IF EXISTS comment_search_vector_idx",
+    "ALTER TABLE app_comment DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_INDEX_COMMENT = (
+    "INSERT INTO app_comment_fts (rowid, text, username, email) "
+    "SELECT {row}.id, {row}.text, u.username, u.email "
+    "FROM app_user u WHERE u.id = {row}.user_id"
+)
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE app_comment_fts USING fts5 (text, username, email)",
+    "CREATE TRIGGER app_comment_fts_insert AFTER INSERT ON app_comment BEGIN "
+    + SQLITE_INDEX_COMMENT.format(row="new")
+    + "; END",
+    "CREATE TRIGGER app_comment_fts_update AFTER UPDATE OF text, user_id ON app_comment BEGIN "
+    "DELETE FROM app_comment_fts WHERE rowid = old.id; "
+    + SQLITE_INDEX_COMMENT.format(row="new")
+    + "; END",
+    "CREATE TRIGGER app_comment_fts_delete AFTER DELETE ON app_comment BEGIN "
+    "DELETE FROM app_comment_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER app_user_fts_update AFTER UPDATE OF username, email ON app_user BEGIN "
+    "UPDATE app_comment_fts SET username = new.username, email = new.email "
+    "WHERE rowid IN (SELECT id FROM app_comment WHERE user_id = new.id); END",
+    "INSERT INTO app_comment_fts (rowid, text, username, email) "
+    "SELECT c.id, c.text, u.username, u.email "
+    "FROM app_comment c JOIN app_user u ON u.id = c.user_id",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS app_user_fts_update",
+    "DROP TRIGGER IF EXISTS app_comment_fts_delete",
+    "DROP TRIGGER IF EXISTS app_comment_fts_update",
+    "DROP TRIGGER IF EXISTS app_comment_fts_insert",
+    "DROP TABLE IF EXISTS app_comment_fts",
+]
+
+
+class TrigramExtension(operations.TrigramExtension):
+    # Django only skips other databases on the way forward
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "postgresql":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {"postgresql": postgres, "sqlite": sqlite}.get(
+            schema_editor.connection.vendor, []
+        )
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_query_plan_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARD, SQLITE_FORWARD),
+            run_for_vendor(POSTGRES_REVERSE, SQLITE_REVERSE),
+        ),
+    ]
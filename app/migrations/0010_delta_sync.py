@@ -0,0 +1,52 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0009_comment_search"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CommentTombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("comment_id", models.BigIntegerField()),
+                ("thread_id", models.BigIntegerField()),
+                ("deleted_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["updated_at", "id"], name="comment_updated_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(
+                fields=["root", "updated_at", "id"], name="comment_thread_updated_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="commenttombstone",
+            index=models.Index(
+                fields=["deleted_at", "id"], name="tombstone_deleted_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="commenttombstone",
+            index=models.Index(
+                fields=["thread_id", "deleted_at", "id"], name="tombstone_thread_idx"
+            ),
+        ),
+    ]
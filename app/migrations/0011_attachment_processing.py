@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:30
+
+from django.db import migrations, models
+
+STATUS_CHOICES = [("pending", "Pending"), ("ready", "Ready"), ("failed", "Failed")]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0010_delta_sync"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="commentattachment",
+            name="staged_file",
+            field=models.FileField(blank=True, upload_to="attachments/staging/"),
+        ),
+        # Existing attachments were uploaded synchronously
+        migrations.AddField(
+            model_name="commentattachment",
+            name="status",
+            field=models.CharField(
+                choices=STATUS_CHOICES, default="ready", max_length=10
+            ),
+        ),
+        migrations.AlterField(
+            model_name="commentattachment",
+            name="status",
+            field=models.CharField(
+                choices=STATUS_CHOICES, default="pending", max_length=10
+            ),
+        ),
+        migrations.AlterField(
+            model_name="commentattachment",
+            name="file",
+            field=models.URLField(blank=True),
+        ),
+    ]
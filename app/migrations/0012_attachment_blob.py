@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0011_attachment_processing"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AttachmentBlob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                ("file", models.URLField()),
+                ("media_type", models.CharField(max_length=50)),
+                ("size", models.PositiveBigIntegerField()),
+                ("reuse_count", models.PositiveIntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="commentattachment",
+            name="sha256",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-17 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0012_attachment_blob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="attachmentblob",
+            name="variants",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="commentattachment",
+            name="variants",
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
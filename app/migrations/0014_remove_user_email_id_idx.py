@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0013_attachment_variants"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="user",
+            name="user_email_id_idx",
+        ),
+    ]
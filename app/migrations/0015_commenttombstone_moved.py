@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0014_remove_user_email_id_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="commenttombstone",
+            name="moved",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-17 04:30
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+search = import_module("app.migrations.0009_comment_search")
+
+# SQLite adds the constraint by rebuilding app_comment, which the search
+# triggers of 0009 don't survive
+SQLITE_TRIGGERS = [s for s in search.SQLITE_FORWARD if s.startswith("CREATE TRIGGER")]
+SQLITE_DROP_TRIGGERS = [
+    s for s in search.SQLITE_REVERSE if s.startswith("DROP TRIGGER")
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0015_commenttombstone_moved"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search.run_for_vendor([], SQLITE_DROP_TRIGGERS),
+            search.run_for_vendor([], SQLITE_TRIGGERS),
+        ),
+        migrations.AddConstraint(
+            model_name="comment",
+            constraint=models.CheckConstraint(
+                condition=models.Q(
+                    models.Q(
+                        ("depth", 0), ("reply__isnull", True), ("root__isnull", True)
+                    ),
+                    models.Q(
+                        ("depth__gt", 0),
+                        ("reply__isnull", False),
+                        ("root__isnull", False),
+                    ),
+                    _connector="OR",
+                ),
+                name="comment_thread_position",
+            ),
+        ),
+        migrations.RunPython(
+            search.run_for_vendor([], SQLITE_TRIGGERS),
+            search.run_for_vendor([], SQLITE_DROP_TRIGGERS),
+        ),
+    ]
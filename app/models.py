@@ -1,5 +1,14 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, F, When
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+# Width of one materialized path segment (a zero-padded comment id)
+PATH_STEP = 10
+# Sorts after every digit under C and locale collations alike, so a subtree
+# is the index range path >= prefix AND path < prefix + PATH_END
+PATH_END = "a"
+MAX_THREAD_DEPTH = 255
 
 
 class User(AbstractUser):
@@ -7,6 +16,16 @@ class User(AbstractUser):
 
 
 class Comment(models.Model):
+    """
+    A comment or a reply, stored as a node of a materialized-path tree.
+
+    ``root``, ``depth``, ``path`` and the ancestors' counters are maintained
+    by ``save()`` and ``app.threads.detach_comment``. ``bulk_create`` bypasses
+    both and is not supported: replies without ``root``/``depth`` are
+    rejected by the ``comment_thread_position`` constraint, and rows without
+    ``path`` are missed by ``subtree_q`` and ``load_threads``.
+    """
+
     user = models.ForeignKey(User, on_delete=models.SET_DEFAULT, default=1)
     text = models.TextField(max_length=1500)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -19,17 +38,172 @@ class Comment(models.Model):
         blank=True,
         related_name="replies",
     )
+    # Top-level comment of the thread; NULL for top-level comments themselves
+    root = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="thread_comments",
+    )
+    depth = models.PositiveIntegerField(default=0)
+    # Ids of all ancestors and the comment itself, PATH_STEP digits each
+    path = models.CharField(max_length=PATH_STEP * MAX_THREAD_DEPTH, default="")
+
+    # Denormalized counters, kept up to date on create and delete and
+    # repaired by the reconcile_comment_counters task
+    reply_count = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["path"], name="comment_path_idx"),
+            models.Index(fields=["root", "path"], name="comment_thread_path_idx"),
+            # Replies of one comment in display order
+            models.Index(
+                fields=["reply", "created_at", "id"], name="comment_replies_idx"
+            ),
+            # Keyset pagination of the top-level list, newest first
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="comment_toplevel_created_idx",
+                condition=models.Q(reply__isnull=True),
+            ),
+            # Ordering by user__username walks the unique username index and
+            # joins each user's top-level comments in id order. Emails are
+            # not unique, so ordering by user__email is a sort either way
+            models.Index(
+                fields=["user", "id"],
+                name="comment_toplevel_user_idx",
+                condition=models.Q(reply__isnull=True),
+            ),
+            models.Index(
+                fields=["-last_activity_at", "-id"],
+                name="comment_toplevel_activity_idx",
+                condition=models.Q(reply__isnull=True),
+            ),
+            # Delta sync, globally and per thread
+            models.Index(fields=["updated_at", "id"], name="comment_updated_idx"),
+            models.Index(
+                fields=["root", "updated_at", "id"], name="comment_thread_updated_idx"
+            ),
+        ]
+        constraints = [
+            # Top-level comments start a thread, replies sit below one. The
+            # path is only known after the insert, so it can't be checked
+            models.CheckConstraint(
+                condition=models.Q(reply__isnull=True, root__isnull=True, depth=0)
+                | models.Q(reply__isnull=False, root__isnull=False, depth__gt=0),
+                name="comment_thread_position",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        parent = self.reply if self.reply_id is not None else None
+        if parent is not None:
+            self.root_id = parent.root_id or parent.id
+            self.depth = parent.depth + 1
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            # The id is known only after the insert
+            self.path = (parent.path if parent else "") + f"{self.pk:0{PATH_STEP}d}"
+            self.last_activity_at = self.created_at
+            Comment.objects.filter(pk=self.pk).update(
+                path=self.path, last_activity_at=self.last_activity_at
+            )
+
+            if parent is not None:
+                Comment.objects.filter(pk__in=self.ancestor_ids()).update(
+                    reply_count=Case(
+                        When(pk=parent.pk, then=F("reply_count") + 1),
+                        default=F("reply_count"),
+                        output_field=models.PositiveIntegerField(),
+                    ),
+                    descendant_count=F("descendant_count") + 1,
+                    last_activity_at=self.created_at,
+                )
+
+    def ancestor_ids(self):
+        return [
+            int(self.path[start : start + PATH_STEP])
+            for start in range(0, len(self.path) - PATH_STEP, PATH_STEP)
+        ]
+
+    @property
+    def thread_id(self):
+        return self.root_id or self.id
 
     def get_root_comment(self):
-        current = self
-        while current.reply is not None:
-            current = current.reply
-        return current
+        if self.root_id is None:
+            return self
+        return self.root
 
 
 class CommentAttachment(models.Model):
+    """
+    A file attached to a comment.
+
+    Uploaded files are staged under MEDIA_ROOT and the attachment stays
+    ``pending`` until the processing task has resized and uploaded it and set
+    ``file`` to its URL.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "pending"
+        READY = "ready"
+        FAILED = "failed"
+
     comment = models.ForeignKey(
         Comment, on_delete=models.CASCADE, related_name="attachments"
     )
+    file = models.URLField(blank=True)
+    media_type = models.CharField(max_length=50)
+    status = models.CharField(
+        max_length=10, choices=Status.choices, default=Status.PENDING
+    )
+    staged_file = models.FileField(upload_to="attachments/staging/", blank=True)
+    # SHA-256 of the uploaded file, see AttachmentBlob
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Images: the original and its resized copies, smallest first, as
+    # {"name", "url", "width", "height", "format"} (see app.media)
+    variants = models.JSONField(default=list, blank=True)
+
+
+class AttachmentBlob(models.Model):
+    """
+    An uploaded file by content: attachments with the same SHA-256 reuse its
+    URL instead of being processed and uploaded again.
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True)
     file = models.URLField()
     media_type = models.CharField(max_length=50)
+    # Size of the uploaded original, and how many uploads it saved
+    size = models.PositiveBigIntegerField()
+    reuse_count = models.PositiveIntegerField(default=0)
+    variants = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class CommentTombstone(models.Model):
+    """A deleted comment, kept for delta sync clients for a limited time"""
+
+    comment_id = models.BigIntegerField()
+    thread_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+    # Still exists, but left ``thread_id`` when its ancestor was deleted
+    moved = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["deleted_at", "id"], name="tombstone_deleted_idx"),
+            models.Index(
+                fields=["thread_id", "deleted_at", "id"], name="tombstone_thread_idx"
+            ),
+        ]
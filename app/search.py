@@ -0,0 +1,100 @@
+"""
+Indexed full-text search over comment text, author username and email.
+
+PostgreSQL: ``app_comment.search_vector`` is a stored generated ``tsvector``
+column with a GIN index, and ``app_user`` has trigram GIN indexes on
+``UPPER(username)`` and ``UPPER(email)``, so Django's ``icontains`` lookups on
+them are index scans. SQLite (local development): an FTS5 table
+``app_comment_fts`` kept in sync by triggers on ``app_comment`` and
+``app_user``. Both are created by migration ``0009_comment_search``. Note that
+on SQLite a migration that rebuilds ``app_comment`` drops its triggers, so
+such a migration has to recreate them.
+"""
+
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVectorField,
+    TrigramSimilarity,
+)
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest
+from rest_framework import filters
+
+from app.models import User
+
+SEARCH_CONFIG = "simple"
+SQLITE_FTS_TABLE = "app_comment_fts"
+
+
+def _postgres_search(queryset, terms):
+    query = SearchQuery(terms, config=SEARCH_CONFIG, search_type="websearch")
+    vector = RawSQL(
+        '"app_comment"."search_vector"', [], output_field=SearchVectorField()
+    )
+    text_match = RawSQL(
+        f'"app_comment"."search_vector" @@ websearch_to_tsquery(\'{SEARCH_CONFIG}\', %s)',
+        [terms],
+        output_field=BooleanField(),
+    )
+    # A subquery keeps the OR on app_comment, so it stays a BitmapOr of indexes
+    authors = User.objects.filter(
+        Q(username__icontains=terms) | Q(email__icontains=terms)
+    ).values("id")
+
+    return queryset.filter(Q(text_match) | Q(user_id__in=authors)).annotate(
+        search_rank=Greatest(
+            SearchRank(vector, query),
+            TrigramSimilarity("user__username", terms),
+            TrigramSimilarity("user__email", terms),
+            output_field=FloatField(),
+        )
+    )
+
+
+def _sqlite_match_expression(terms):
+    """Every term as a quoted FTS5 prefix phrase, all of them required"""
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+
+
+def _sqlite_search(queryset, terms):
+    match = _sqlite_match_expression(terms)
+    matching_ids = RawSQL(
+        f"SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s",
+        [match],
+    )
+    # bm25() is lower for better matches
+    rank = RawSQL(
+        f"SELECT -bm25({SQLITE_FTS_TABLE}) FROM {SQLITE_FTS_TABLE} "
+        f'WHERE {SQLITE_FTS_TABLE} MATCH %s AND rowid = "app_comment"."id"',
+        [match],
+        output_field=FloatField(),
+    )
+    return queryset.filter(pk__in=matching_ids).annotate(search_rank=rank)
+
+
+class CommentSearchFilter(filters.SearchFilter):
+    """
+    ``?search=`` over comment text, username and email backed by the search
+    indexes. Results are ordered by relevance unless ``?ordering=`` is given.
+    Other database backends fall back to DRF's ``icontains`` search over
+    ``search_fields``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+
+        if connection.vendor == "postgresql":
+            queryset = _postgres_search(queryset, " ".join(terms))
+        elif connection.vendor == "sqlite":
+            queryset = _sqlite_search(queryset, terms)
+        else:
+            return super().filter_queryset(request, queryset, view)
+
+        if filters.OrderingFilter.ordering_param in request.query_params:
+            return queryset
+        return queryset.order_by("-search_rank", "-id")
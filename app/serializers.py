@@ -1,18 +1,30 @@
-import io
+import html
 import os
-import requests
-from PIL import Image
-from django.core.files.base import ContentFile
+from functools import partial
 from django.conf import settings
+from django.db import transaction
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
 import bleach
 from rest_framework import serializers
-import cloudinary.uploader
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from app.models import Comment, User, CommentAttachment
-from app.tasks import send_reply_notification_email
+from app.exceptions import RecaptchaUnavailable
+from app.models import Comment, User, CommentAttachment, MAX_THREAD_DEPTH
+from app.recaptcha import get_verifier
+from app.media import (
+    IMAGE_EXTENSIONS,
+    MAX_IMAGE_PIXELS,
+    file_digest,
+    image_size,
+    sniff_format,
+    stage_attachments,
+)
+from app.tasks import process_comment_attachment, send_reply_notification_email
+from app.threads import load_threads
+from app.utils import ReplyPagination
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -47,14 +59,82 @@ class RegistrationSerializer(serializers.ModelSerializer):
 
 
 class CommentPreviewSerializer(serializers.ModelSerializer):
+    """Top-level comment with a short plain-text excerpt instead of the text"""
+
+    EXCERPT_LENGTH = 200
+
+    excerpt = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Comment
+        fields = ["id", "excerpt", "created_at"]
+
+    def get_excerpt(self, obj) -> str:
+        text = html.unescape(strip_tags(obj.text))
+        return Truncator(" ".join(text.split())).chars(self.EXCERPT_LENGTH)
+
+
+class CommentChangeSerializer(serializers.ModelSerializer):
+    """Single comment without replies, as returned by delta sync"""
+
+    user = UserSerializer(read_only=True)
+    thread = serializers.IntegerField(source="thread_id", read_only=True)
+    replies_count = serializers.IntegerField(source="reply_count", read_only=True)
+    attachments = serializers.SerializerMethodField()
+
     class Meta:
         model = Comment
-        fields = ["id", "text", "created_at"]
+        fields = [
+            "id",
+            "user",
+            "text",
+            "created_at",
+            "updated_at",
+            "reply",
+            "thread",
+            "replies_count",
+            "descendant_count",
+            "last_activity_at",
+            "attachments",
+        ]
+
+    def get_attachments(self, obj):
+        return [
+            {
+                "id": a.id,
+                "file": a.file,
+                "media_type": a.media_type,
+                "status": a.status,
+                "variants": a.variants,
+            }
+            for a in obj.attachments.all()
+        ]
+
+
+class CommentListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        comments = list(data.all() if hasattr(data, "all") else data)
+        load_threads(
+            [c for c in comments if not hasattr(c, "thread_replies")],
+            max_depth=self.context.get("max_depth"),
+        )
+        return super().to_representation(comments)
 
 
 class CommentSerializer(serializers.ModelSerializer):
+    """
+    Comment with its nested replies.
+
+    Context keys ``max_depth`` and ``replies_limit`` bound the nested output.
+    A comment whose replies were cut off reports the full ``replies_count``
+    and a ``replies_cursor`` for the comment-replies endpoint to continue from;
+    the cursor is null when no replies were included (start from the beginning).
+    """
+
     user = UserSerializer(read_only=True)
     replies = serializers.SerializerMethodField()
+    replies_count = serializers.SerializerMethodField()
+    replies_cursor = serializers.SerializerMethodField()
     attachments = serializers.SerializerMethodField()
 
     class Meta:
@@ -67,21 +147,61 @@ class CommentSerializer(serializers.ModelSerializer):
             "updated_at",
             "reply",
             "replies",
+            "replies_count",
+            "replies_cursor",
+            "descendant_count",
+            "last_activity_at",
+            "attachments",
+        ]
+        read_only_fields = [
+            "id",
+            "created_at",
+            "updated_at",
+            "user",
+            "descendant_count",
+            "last_activity_at",
             "attachments",
         ]
-        read_only_fields = ["id", "created_at", "updated_at", "user", "attachments"]
+        list_serializer_class = CommentListSerializer
+
+    def to_representation(self, instance):
+        if not hasattr(instance, "thread_replies"):
+            load_threads([instance], max_depth=self.context.get("max_depth"))
+        return super().to_representation(instance)
+
+    def _included_replies(self, obj):
+        if obj.thread_replies is None:
+            return []
+        return obj.thread_replies[: self.context.get("replies_limit")]
 
     def get_attachments(self, obj):
         return [
-            {"id": a.id, "file": a.file, "media_type": a.media_type}
+            {
+                "id": a.id,
+                "file": a.file,
+                "media_type": a.media_type,
+                "status": a.status,
+                "variants": a.variants,
+            }
             for a in obj.attachments.all()
         ]
 
     def get_replies(self, obj):
-        """Get all replies to this comment"""
-        if obj.replies.exists():
-            return CommentSerializer(obj.replies.all(), many=True).data
-        return []
+        """Get replies to this comment from the preloaded thread"""
+        return CommentSerializer(
+            self._included_replies(obj), many=True, context=self.context
+        ).data
+
+    def get_replies_count(self, obj):
+        if obj.thread_replies is None:
+            return obj.reply_count
+        return len(obj.thread_replies)
+
+    def get_replies_cursor(self, obj):
+        included = self._included_replies(obj)
+        if not included or len(included) == self.get_replies_count(obj):
+            return None
+        return ReplyPagination().encode_cursor(included[-1])
 
 
 class CommentCreateSerializer(serializers.ModelSerializer):
@@ -124,24 +244,30 @@ class CommentCreateSerializer(serializers.ModelSerializer):
 
         return cleaned_text
 
+    def validate_reply(self, value):
+        if self.instance is not None and value != self.instance.reply:
+            raise serializers.ValidationError(
+                "A comment cannot be moved to another thread."
+            )
+        if value is not None and value.depth + 1 >= MAX_THREAD_DEPTH:
+            raise serializers.ValidationError("This thread is too deep to reply to.")
+        return value
+
     def validate_recaptcha_token(self, value):
-        """Validate reCAPTCHA token with Google's API"""
+        """Validate reCAPTCHA token with the configured verifier (app.recaptcha)"""
         if not settings.RECAPTCHA_PRIVATE_KEY:
             raise serializers.ValidationError(
                 "reCAPTCHA is not configured on the server"
             )
 
-        # Send verification request to Google
-        response = requests.post(
-            "https://www.google.com/recaptcha/api/siteverify",
-            data={
-                "secret": settings.RECAPTCHA_PRIVATE_KEY,
-                "response": value,
-            },
-            timeout=10,
-        )
-
-        result = response.json()
+        request = self.context.get("request")
+        remote_ip = request.META.get("REMOTE_ADDR") if request else None
+        try:
+            result = get_verifier().verify(value, remote_ip)
+        except RecaptchaUnavailable:
+            raise serializers.ValidationError(
+                "CAPTCHA could not be verified. Please try again."
+            )
 
         if not result.get("success", False):
             error_codes = result.get("error-codes", [])
@@ -154,76 +280,73 @@ class CommentCreateSerializer(serializers.ModelSerializer):
         return value
 
     def validate_attachments(self, attachments):
-        for i, file in enumerate(attachments):
+        """Checked files with their SHA-256, as ``(file, sha256)`` pairs"""
+        for file in attachments:
             ext = os.path.splitext(file.name)[1].lower()
             if ext == ".txt":
                 if file.size > 100 * 1024:
                     raise serializers.ValidationError(
                         f"File {file.name} is too big. Max TXT file size is 100KB."
                     )
-                continue
-            elif ext in [".jpg", ".jpeg", ".png", ".gif"]:
+                self._check_text(file)
+            elif ext in IMAGE_EXTENSIONS:
                 if file.size > 5 * 1024 * 1024:
                     raise serializers.ValidationError(
                         f"File {file.name} is too big. Max JPG, PNG, GIF file size is 5MB."
                     )
-                file = self._process_image(file, ext)
-                attachments[i] = file
+                self._check_image(file)
             else:
                 raise serializers.ValidationError(
                     f"File {file.name} has invalid format. Only TXT, JPG, PNG, GIF allowed."
                 )
 
-        return attachments
-
-    def _process_image(self, file, ext):
-        try:
-            image = Image.open(file)
-
-            if image.width > 320 or image.height > 240:
-                image.thumbnail((320, 240))
-
-                output = io.BytesIO()
-                img_format = (
-                    image.format if image.format else ext.replace(".", "").upper()
-                )
-                if img_format == "JPG":
-                    img_format = "JPEG"
-
-                image.save(output, format=img_format)
-                output.seek(0)
+        return [(file, file_digest(file)) for file in attachments]
 
-                return ContentFile(output.read(), name=file.name)
+    def _check_text(self, file):
+        header = file.read(1024)
+        file.seek(0)
+        if sniff_format(file) is not None or b"\0" in header:
+            raise serializers.ValidationError(f"Invalid text file: {file.name}")
 
-            return file
-        except Exception:
+    def _check_image(self, file):
+        # Magic number and header only; resizing is done by the worker
+        # (app.media)
+        image_format = sniff_format(file)
+        try:
+            if image_format is None:
+                raise ValueError
+            width, height = image_size(file, image_format)
+        except ValueError:
             raise serializers.ValidationError(f"Invalid image file: {file.name}")
+        if width * height > MAX_IMAGE_PIXELS:
+            raise serializers.ValidationError(
+                f"Image {file.name} is too large: {width}x{height} pixels."
+            )
 
     def create(self, validated_data):
         attachments_data = validated_data.pop("attachments", [])
         validated_data.pop("recaptcha_token", None)
         user = self.context["request"].user
         validated_data["user"] = user
-        comment = super().create(validated_data)
-
-        for file in attachments_data:
-            ext = os.path.splitext(file.name)[1].lower()
-            media_type = "image" if ext in [".jpg", ".jpeg", ".png", ".gif"] else "file"
 
+        # Files are staged under MEDIA_ROOT; resizing and upload happen in
+        # the worker once the comment is committed
+        with transaction.atomic():
+            comment = super().create(validated_data)
+            attachments = stage_attachments(comment, attachments_data)
             try:
-                cloudinary_file = cloudinary.uploader.upload(
-                    file,
-                    resource_type="auto",
+                CommentAttachment.objects.bulk_create(attachments)
+            except Exception:
+                for attachment in attachments:
+                    if attachment.staged_file:
+                        attachment.staged_file.delete(save=False)
+                raise
+
+        for attachment in attachments:
+            if attachment.status == CommentAttachment.Status.PENDING:
+                transaction.on_commit(
+                    partial(process_comment_attachment.delay, attachment.id)
                 )
-                file_url = cloudinary_file["secure_url"]
-            except cloudinary.exceptions.Error:
-                raise serializers.ValidationError("Failed to upload file to Cloudinary")
-
-            CommentAttachment.objects.create(
-                comment=comment, file=file_url, media_type=media_type
-            )
-
-        comment.attachments.set(CommentAttachment.objects.filter(comment=comment))
 
         if comment.reply:
             self._send_reply_notification(comment, user)
@@ -235,7 +358,7 @@ class CommentCreateSerializer(serializers.ModelSerializer):
         channel_layer = get_channel_layer()
         serialized_reply = CommentSerializer(comment).data
 
-        group_name = f"comment_{root_comment.id}"
+        group_name = f"comment_{comment.thread_id}"
         async_to_sync(channel_layer.group_send)(
             group_name, {"type": "new_reply", "reply": serialized_reply}
         )
@@ -1,14 +1,117 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from django.core.cache import cache
+from django.utils import timezone
 
-from app.models import Comment
+from app.caching import (
+    AUTHORS,
+    COMMENTS_LIST,
+    PREVIEW_LIST,
+    invalidate,
+    thread_content_tag,
+    thread_tag,
+)
+from app.models import Comment, CommentAttachment, CommentTombstone, User
+from app.thread_cache import append_reply
+from app.threads import detach_comment
+
+# Поля пользователя, которые попадают в вывод комментариев
+USER_RENDERED_FIELDS = {"username", "email"}
+
+
+def _comment_tags(thread_id):
+    return [thread_tag(thread_id), thread_content_tag(thread_id), COMMENTS_LIST]
 
 
 @receiver(post_save, sender=Comment)
-def notify_reply_created(sender, instance, created, **kwargs):
+def invalidate_on_comment_save(sender, instance, created, **kwargs):
+    """
+    Инвалидирует кэш ветки и списков при создании или изменении
+    комментария. Превью зависит только от корневых комментариев.
+    Новый ответ не сбрасывает JSON ветки, а дописывается в него после коммита
+    """
+    tags = _comment_tags(instance.thread_id)
+    if instance.reply_id is None:
+        tags.append(PREVIEW_LIST)
+    elif created:
+        tags.remove(thread_content_tag(instance.thread_id))
+        transaction.on_commit(lambda: append_reply(instance.pk))
+    invalidate(*tags)
+
+
+@receiver(pre_delete, sender=Comment)
+def detach_comment_on_delete(sender, instance, **kwargs):
+    """
+    Убирает комментарий из ветки: его ответы становятся корнями собственных
+    веток, а счётчики предков уменьшаются. Синхронизация старой ветки
+    получает надгробия перенесённых комментариев
+    """
+    moved = detach_comment(instance)
+    CommentTombstone.objects.bulk_create(
+        CommentTombstone(comment_id=pk, thread_id=instance.thread_id, moved=True)
+        for pk in moved
+    )
+
+
+@receiver(post_delete, sender=Comment)
+def invalidate_on_comment_delete(sender, instance, **kwargs):
+    """
+    Инвалидирует кэш после удаления комментария. Превью меняется всегда:
+    ответы удалённого комментария стали корневыми
+    """
+    invalidate(*_comment_tags(instance.thread_id), PREVIEW_LIST)
+
+
+@receiver(post_delete, sender=Comment)
+def record_comment_deletion(sender, instance, **kwargs):
+    """
+    Оставляет надгробие удалённого комментария для дельта-синхронизации
+    """
+    CommentTombstone.objects.create(
+        comment_id=instance.pk, thread_id=instance.thread_id
+    )
+
+
+@receiver(post_save, sender=CommentAttachment)
+@receiver(post_delete, sender=CommentAttachment)
+def invalidate_on_attachment_change(sender, instance, **kwargs):
+    """
+    Инвалидирует кэш комментария, к которому относится вложение
+    """
+    comment = (
+        Comment.objects.filter(pk=instance.comment_id).values("id", "root_id").first()
+    )
+    if comment is not None:
+        thread_id = comment["root_id"] or comment["id"]
+        invalidate(*_comment_tags(thread_id))
+
+
+@receiver(post_save, sender=CommentAttachment)
+@receiver(post_delete, sender=CommentAttachment)
+def touch_comment_on_attachment_change(sender, instance, **kwargs):
+    """
+    Обновляет updated_at комментария: вложения входят в его вывод,
+    и дельта-синхронизация должна вернуть комментарий заново
+    """
+    Comment.objects.filter(pk=instance.comment_id).update(updated_at=timezone.now())
+
+
+@receiver(post_delete, sender=CommentAttachment)
+def delete_staged_file(sender, instance, **kwargs):
+    """
+    Удаляет загруженный файл вложения, которое удалили до обработки
+    """
+    if instance.staged_file:
+        instance.staged_file.delete(save=False)
+
+
+@receiver(post_save, sender=User)
+def invalidate_on_user_change(sender, instance, created, update_fields, **kwargs):
     """
-    Очищает кэш при создании нового корневого комментария
+    Инвалидирует закэшированные документы при смене имени или email:
+    они входят в вывод комментариев. Сохранения других полей (например,
+    last_login при входе) кэш не трогают
     """
-    if created and instance.reply is None:
-        cache.delete("comment_preview_list")
+    if created or (update_fields and not USER_RENDERED_FIELDS & set(update_fields)):
+        return
+    invalidate(AUTHORS)
@@ -0,0 +1,92 @@
+"""
+Where processed attachments are stored.
+
+The backend is chosen with the ``ATTACHMENT_STORAGE`` setting (a dotted path)
+and built once per process. ``save`` takes a file object and its name and
+returns the URL the attachment is served from; failures that may pass on a
+retry raise ``AttachmentStorageError``.
+
+``CloudinaryStorage`` uploads to Cloudinary. ``LocalStorage`` keeps files
+under ``ATTACHMENT_STORAGE_ROOT`` (default MEDIA_ROOT/attachments), writing
+each one to a temporary file that is renamed into place, so a file is never
+seen half-written. The ``attachment-file`` view hands them to nginx with
+``X-Accel-Redirect`` when ``ATTACHMENT_X_ACCEL_REDIRECT`` is set to the
+internal location that maps to the root (``/protected-attachments/`` in
+vue_ui/nginx.conf, set for the backend in docker-compose.yml), so nginx
+sends them from disk. Otherwise Django streams them a chunk at a time.
+"""
+
+import functools
+import os
+import tempfile
+import uuid
+
+import cloudinary.exceptions
+import cloudinary.uploader
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from app.exceptions import AttachmentStorageError
+
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentStorage:
+    def save(self, file, name):
+        """Store ``file`` and return its URL"""
+        raise NotImplementedError
+
+
+class CloudinaryStorage(AttachmentStorage):
+    def save(self, file, name):
+        try:
+            result = cloudinary.uploader.upload(file, resource_type="auto")
+        except cloudinary.exceptions.Error as exc:
+            raise AttachmentStorageError(str(exc)) from exc
+        return result["secure_url"]
+
+
+class LocalStorage(AttachmentStorage):
+    def __init__(self, root=None, base_url=None):
+        self.root = (
+            root
+            or settings.ATTACHMENT_STORAGE_ROOT
+            or os.path.join(settings.MEDIA_ROOT, "attachments")
+        )
+        self.base_url = base_url or settings.ATTACHMENT_STORAGE_URL
+
+    def path(self, stored_name):
+        return os.path.join(self.root, stored_name)
+
+    def save(self, file, name):
+        # Unique names: files are never overwritten and can be cached forever
+        stored_name = uuid.uuid4().hex + os.path.splitext(name)[1].lower()
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+            try:
+                with os.fdopen(fd, "wb") as temp:
+                    while chunk := file.read(CHUNK_SIZE):
+                        temp.write(chunk)
+                    temp.flush()
+                    os.fsync(temp.fileno())
+                os.replace(temp_path, self.path(stored_name))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as exc:
+            raise AttachmentStorageError(str(exc)) from exc
+        return self.base_url + stored_name
+
+
+@functools.cache
+def get_storage():
+    return import_string(settings.ATTACHMENT_STORAGE)()
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    if setting.startswith("ATTACHMENT_") or setting == "MEDIA_ROOT":
+        get_storage.cache_clear()
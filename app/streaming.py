@@ -0,0 +1,87 @@
+"""
+JSON streamed row by row, for threads and exports too large to build in memory.
+
+Rows are read with ``QuerySet.iterator(chunk_size=...)`` (a server-side cursor
+on PostgreSQL), serialized one at a time and yielded as JSON fragments
+through ``StreamingHttpResponse``, so memory stays at one chunk of rows
+whatever the size of the response.
+
+Under ASGI (the deployment runs uvicorn workers) Django would read a
+synchronous iterator to the end with ``sync_to_async(list)`` before sending
+anything, so there the fragments are handed over as an asynchronous
+iterator that pulls one chunk at a time through ``sync_to_async``. The
+database cursor stays on the request's thread, which ``sync_to_async``
+keeps for every call of a request.
+
+Comments are serialized with ``CommentChangeSerializer``. In a streamed
+thread every comment also gets its ``replies``: the subtree is read in path
+order, which is depth-first, so a comment is closed as soon as a row that is
+not below it comes in and only the open ancestors are kept. Replies are
+listed oldest first.
+"""
+
+import itertools
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+from app.renderers import dumps
+from app.serializers import CommentChangeSerializer
+from app.threads import subtree
+
+CHUNK_SIZE = 2000
+
+
+def _render(comment):
+    return dumps(CommentChangeSerializer(comment).data)
+
+
+def _rows(queryset):
+    return (
+        queryset.select_related("user")
+        .prefetch_related("attachments")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def stream_array(queryset):
+    """The comments of ``queryset`` as one JSON array, in the queryset's order"""
+    yield b"["
+    for i, comment in enumerate(_rows(queryset)):
+        yield _render(comment) if i == 0 else b"," + _render(comment)
+    yield b"]"
+
+
+def stream_thread(comment):
+    """``comment`` with all of its replies nested, as one JSON object"""
+    # Depth of every open comment and whether it has a reply written yet
+    open_nodes = []
+    for node in _rows(subtree(comment, include_self=True)):
+        while open_nodes and open_nodes[-1][0] >= node.depth:
+            open_nodes.pop()
+            yield b"]}"
+        separator = b""
+        if open_nodes:
+            separator = b"," if open_nodes[-1][1] else b""
+            open_nodes[-1][1] = True
+        yield separator + _render(node)[:-1] + b',"replies":['
+        open_nodes.append([node.depth, False])
+    for _ in open_nodes:
+        yield b"]}"
+
+
+async def _chunked(chunks):
+    """``chunks`` as an asynchronous iterator, one CHUNK_SIZE batch at a time"""
+
+    def batch():
+        return b"".join(itertools.islice(chunks, CHUNK_SIZE))
+
+    while data := await sync_to_async(batch)():
+        yield data
+
+
+def streaming_json_response(request, chunks, **kwargs):
+    if isinstance(getattr(request, "_request", request), ASGIRequest):
+        chunks = _chunked(chunks)
+    return StreamingHttpResponse(chunks, content_type="application/json", **kwargs)
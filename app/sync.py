@@ -0,0 +1,134 @@
+"""
+Delta sync: comments changed or deleted after a cursor.
+
+Changed comments are read in ``(updated_at, id)`` order from the
+``comment_updated_idx`` / ``comment_thread_updated_idx`` indexes, deletions
+from ``CommentTombstone`` rows written by the delete signal. The cursor holds
+the position reached in both, so a client that keeps passing back the cursor
+it got sees every change exactly once, and never rescans what it already has.
+
+``updated_at`` is set when a row is saved, not when its transaction commits,
+so rows newer than ``SETTLE_TIME`` are left for the next request: a slower
+transaction may still commit rows with an earlier timestamp. Reply counters
+and ``last_activity_at`` of ancestors follow from the changed and deleted
+replies and don't move the ancestors themselves.
+
+When a deleted comment's replies become threads of their own, they move to
+the new threads with a fresh ``updated_at``. The old thread gets ``moved``
+tombstones for them, so ``?thread=`` clients drop them too. Global sync
+skips those tombstones because it sees the moves as changes.
+
+Tombstones are kept for ``TOMBSTONE_RETENTION``; a cursor older than that
+can't be served and gets a 410, after which the client starts over.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime, timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+
+from app.exceptions import SyncCursorExpired
+from app.models import Comment, CommentTombstone
+
+SETTLE_TIME = timedelta(seconds=2)
+TOMBSTONE_RETENTION = timedelta(days=30)
+INVALID_CURSOR_MESSAGE = "Invalid cursor"
+
+
+def encode_cursor(changed, deleted):
+    payload = json.dumps(
+        {
+            "c": [changed[0].isoformat(), changed[1]],
+            "d": [deleted[0].isoformat(), deleted[1]],
+        }
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(encoded):
+    """``(changed, deleted)`` positions, each a ``(timestamp, id)`` pair"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        positions = tuple(
+            (datetime.fromisoformat(payload[name][0]), int(payload[name][1]))
+            for name in ("c", "d")
+        )
+        # Cursors are written with aware timestamps
+        if any(timezone.is_naive(timestamp) for timestamp, _ in positions):
+            raise ValueError
+        return positions
+    except (binascii.Error, ValueError, TypeError, KeyError, IndexError):
+        raise NotFound(INVALID_CURSOR_MESSAGE)
+
+
+def _after(field, position):
+    timestamp, pk = position
+    return Q(**{f"{field}__gt": timestamp}) | Q(**{field: timestamp, "id__gt": pk})
+
+
+def _page(queryset, field, position, until, limit):
+    queryset = queryset.filter(**{f"{field}__lt": until})
+    if position is not None:
+        queryset = queryset.filter(_after(field, position))
+    rows = list(queryset.order_by(field, "id")[: limit + 1])
+    return rows[:limit], len(rows) > limit
+
+
+def changes(cursor=None, thread_id=None, limit=100):
+    """
+    Comments changed and ids of comments deleted after ``cursor``.
+
+    Returns ``(changed, deleted_ids, next_cursor, has_more)``. Without a
+    cursor every comment is returned, and deletions are tracked from now on.
+    ``thread_id`` restricts both to one thread, and then comments moved out
+    of it count as deleted.
+    """
+    until = timezone.now() - SETTLE_TIME
+    if cursor is None:
+        changed_position, deleted_position = None, (until, 0)
+    else:
+        changed_position, deleted_position = decode_cursor(cursor)
+        if deleted_position[0] < timezone.now() - TOMBSTONE_RETENTION:
+            raise SyncCursorExpired()
+
+    comments = Comment.objects.select_related("user").prefetch_related("attachments")
+    tombstones = CommentTombstone.objects.all()
+    if thread_id is not None:
+        comments = comments.filter(Q(pk=thread_id) | Q(root_id=thread_id))
+        tombstones = tombstones.filter(thread_id=thread_id)
+    else:
+        tombstones = tombstones.filter(moved=False)
+
+    changed, more_changed = _page(
+        comments, "updated_at", changed_position, until, limit
+    )
+    deleted, more_deleted = _page(
+        tombstones, "deleted_at", deleted_position, until, limit
+    )
+
+    # A page that isn't full read everything before ``until``
+    changed_position = (
+        (changed[-1].updated_at, changed[-1].id) if more_changed else (until, 0)
+    )
+    deleted_position = (
+        (deleted[-1].deleted_at, deleted[-1].id) if more_deleted else (until, 0)
+    )
+
+    return (
+        changed,
+        [tombstone.comment_id for tombstone in deleted],
+        encode_cursor(changed_position, deleted_position),
+        more_changed or more_deleted,
+    )
+
+
+def purge_tombstones():
+    """Drop tombstones past the retention window, returns how many"""
+    deleted, _ = CommentTombstone.objects.filter(
+        deleted_at__lt=timezone.now() - TOMBSTONE_RETENTION
+    ).delete()
+    return deleted
@@ -1,11 +1,22 @@
+from itertools import batched
+
 from django.conf import settings
+from django.db.models import F, OuterRef
 from django.template.loader import render_to_string
 from django.core.mail import EmailMultiAlternatives
 
 from django_celery_results.models import TaskResult
 
 from comments_api.celery import app
-from app.exceptions import EmailSendingError
+from app.caching import COMMENTS_LIST, invalidate, thread_content_tag, thread_tag
+from app.exceptions import (
+    AttachmentStorageError,
+    EmailSendingError,
+    ThreadDocumentBusy,
+)
+from app.media import fail_attachment, process_attachment
+from app.models import Comment
+from app.threads import subtree_aggregate, subtree_q
 
 
 @app.task(autoretry_for=(EmailSendingError,), max_retries=3, retry_backoff=True)
@@ -38,3 +49,85 @@ def cleanup_failed_email_tasks():
     failed_tasks = TaskResult.objects.filter(status="FAILURE")
     for task in failed_tasks:
         task.delete()
+
+
+@app.task
+def reconcile_comment_counters(batch_size=500):
+    """
+    Recompute reply_count, descendant_count and last_activity_at and repair
+    every comment whose stored values drifted. Returns the number of repairs.
+    """
+    repaired = 0
+    ids = Comment.objects.order_by("pk").values_list("pk", flat=True)
+
+    for chunk in batched(ids.iterator(), batch_size):
+        stale = (
+            Comment.objects.filter(pk__in=chunk)
+            .annotate(
+                real_reply_count=subtree_aggregate("COUNT", "pk", reply=OuterRef("pk")),
+                real_descendant_count=subtree_aggregate(
+                    "COUNT",
+                    "pk",
+                    subtree_q(OuterRef("path")),
+                    depth__gt=OuterRef("depth"),
+                ),
+                real_last_activity_at=subtree_aggregate(
+                    "MAX", "created_at", subtree_q(OuterRef("path"))
+                ),
+            )
+            .exclude(
+                reply_count=F("real_reply_count"),
+                descendant_count=F("real_descendant_count"),
+                last_activity_at=F("real_last_activity_at"),
+            )
+        )
+
+        fixed = []
+        for comment in stale:
+            comment.reply_count = comment.real_reply_count
+            comment.descendant_count = comment.real_descendant_count
+            comment.last_activity_at = comment.real_last_activity_at
+            fixed.append(comment)
+
+        Comment.objects.bulk_update(
+            fixed, ["reply_count", "descendant_count", "last_activity_at"]
+        )
+        if fixed:
+            thread_ids = {comment.thread_id for comment in fixed}
+            invalidate(
+                COMMENTS_LIST,
+                *(thread_tag(thread_id) for thread_id in thread_ids),
+                *(thread_content_tag(thread_id) for thread_id in thread_ids),
+            )
+        repaired += len(fixed)
+
+    return repaired
+
+
+@app.task
+def purge_comment_tombstones():
+    """Drop delta sync tombstones past their retention window"""
+    from app.sync import purge_tombstones
+
+    return purge_tombstones()
+
+
+@app.task(autoretry_for=(ThreadDocumentBusy,), max_retries=5, retry_backoff=True)
+def render_thread_document(thread_id):
+    """Re-render the cached JSON of a thread that could not be patched"""
+    from app.thread_cache import rebuild_document
+
+    if not rebuild_document(thread_id):
+        raise ThreadDocumentBusy(thread_id)
+
+
+@app.task(bind=True, max_retries=3)
+def process_comment_attachment(self, attachment_id):
+    """Resize and store a staged attachment, retrying storage errors"""
+    try:
+        return process_attachment(attachment_id)
+    except AttachmentStorageError as exc:
+        if self.request.retries >= self.max_retries:
+            fail_attachment(attachment_id)
+            return True
+        raise self.retry(exc=exc, countdown=2**self.request.retries)
@@ -1,6 +1,13 @@
+import base64
 import json
+import os
+import re
+from datetime import datetime, timedelta
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
@@ -9,7 +16,7 @@ from channels.testing import WebsocketCommunicator
 from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
 
-from .models import Comment
+from .models import Comment, CommentAttachment, CommentTombstone
 from .consumers import ReplyConsumer
 from .serializers import CommentSerializer, CommentCreateSerializer
 
@@ -64,6 +71,136 @@ class CommentModelTest(TestCase):
         self.assertIsNotNone(comment.created_at)
         self.assertIsNotNone(comment.updated_at)
 
+    def test_reply_stores_root_and_depth(self):
+        """Тест сохранения корня ветки и глубины ответа"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        child = Comment.objects.create(user=self.user, text="Child", reply=root)
+        grandchild = Comment.objects.create(user=self.user, text="Deep", reply=child)
+
+        self.assertIsNone(root.root_id)
+        self.assertEqual(root.depth, 0)
+        self.assertEqual(child.root_id, root.id)
+        self.assertEqual(grandchild.root_id, root.id)
+        self.assertEqual(grandchild.depth, 2)
+        self.assertEqual(grandchild.thread_id, root.id)
+        self.assertEqual(root.thread_id, root.id)
+
+    def test_get_root_comment_single_query(self):
+        """Тест получения корня ветки одним запросом"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        current = root
+        for i in range(10):
+            current = Comment.objects.create(user=self.user, text=f"{i}", reply=current)
+
+        leaf = Comment.objects.get(pk=current.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(leaf.get_root_comment(), root)
+
+    def test_delete_parent_makes_replies_roots(self):
+        """Тест что ответы удалённого комментария становятся корнями"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        child = Comment.objects.create(user=self.user, text="Child", reply=root)
+        grandchild = Comment.objects.create(user=self.user, text="Deep", reply=child)
+        leaf = Comment.objects.create(user=self.user, text="Leaf", reply=grandchild)
+
+        child.delete()
+
+        grandchild.refresh_from_db()
+        leaf.refresh_from_db()
+        self.assertIsNone(grandchild.reply_id)
+        self.assertIsNone(grandchild.root_id)
+        self.assertEqual(grandchild.depth, 0)
+        self.assertEqual(leaf.root_id, grandchild.id)
+        self.assertEqual(leaf.depth, 1)
+
+        root.delete()
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.root_id, grandchild.id)
+
+    def test_materialized_path(self):
+        """Тест построения материализованного пути"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        child = Comment.objects.create(user=self.user, text="Child", reply=root)
+        grandchild = Comment.objects.create(user=self.user, text="Deep", reply=child)
+
+        grandchild.refresh_from_db()
+        self.assertEqual(
+            grandchild.path, f"{root.id:010d}{child.id:010d}{grandchild.id:010d}"
+        )
+        self.assertTrue(grandchild.path.startswith(child.path))
+
+    def test_subtree_queries(self):
+        """Тест выборки поддерева, подсчёта потомков и последнего ответа"""
+        from app.threads import descendant_count, latest_reply, subtree
+
+        root = Comment.objects.create(user=self.user, text="Root")
+        a = Comment.objects.create(user=self.user, text="A", reply=root)
+        b = Comment.objects.create(user=self.user, text="B", reply=root)
+        a1 = Comment.objects.create(user=self.user, text="A1", reply=a)
+        Comment.objects.create(user=self.user, text="Other thread")
+
+        with self.assertNumQueries(1):
+            ordered = [c.text for c in subtree(root)]
+        self.assertEqual(ordered, ["A", "A1", "B"])
+        self.assertEqual(descendant_count(root), 3)
+        self.assertEqual(descendant_count(a), 1)
+        self.assertEqual(latest_reply(root), a1)
+        self.assertNotEqual(latest_reply(root), b)
+
+    def test_delete_rewrites_paths(self):
+        """Тест перестройки путей при удалении комментария"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        child = Comment.objects.create(user=self.user, text="Child", reply=root)
+        grandchild = Comment.objects.create(user=self.user, text="Deep", reply=child)
+        leaf = Comment.objects.create(user=self.user, text="Leaf", reply=grandchild)
+
+        root.delete()
+
+        child.refresh_from_db()
+        leaf.refresh_from_db()
+        self.assertEqual(child.path, f"{child.id:010d}")
+        self.assertEqual(
+            leaf.path, f"{child.id:010d}{grandchild.id:010d}{leaf.id:010d}"
+        )
+        self.assertEqual(leaf.root_id, child.id)
+        self.assertEqual(leaf.depth, 2)
+
+    def test_counters_on_create_and_delete(self):
+        """Тест счётчиков ответов, потомков и последней активности"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        child = Comment.objects.create(user=self.user, text="Child", reply=root)
+        sibling = Comment.objects.create(user=self.user, text="Sibling", reply=root)
+        deep = Comment.objects.create(user=self.user, text="Deep", reply=child)
+
+        root.refresh_from_db()
+        child.refresh_from_db()
+        self.assertEqual(root.reply_count, 2)
+        self.assertEqual(root.descendant_count, 3)
+        self.assertEqual(root.last_activity_at, deep.created_at)
+        self.assertEqual(child.reply_count, 1)
+        self.assertEqual(child.descendant_count, 1)
+
+        child.delete()
+        root.refresh_from_db()
+        self.assertEqual(root.reply_count, 1)
+        self.assertEqual(root.descendant_count, 1)
+        # Последняя активность - по оставшимся ответам
+        self.assertEqual(root.last_activity_at, sibling.created_at)
+
+        from app.tasks import reconcile_comment_counters
+
+        self.assertEqual(reconcile_comment_counters(), 0)
+
+    def test_bulk_created_reply_rejected(self):
+        """Тест что ответ без корня и глубины не сохраняется в обход save()"""
+        from django.db import IntegrityError, transaction
+
+        root = Comment.objects.create(user=self.user, text="Root")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Comment.objects.bulk_create(
+                [Comment(user=self.user, text="Reply", reply=root)]
+            )
+
 
 class CommentSerializerTest(TestCase):
     """Тесты для сериализаторов комментариев"""
@@ -96,6 +233,48 @@ class CommentSerializerTest(TestCase):
         self.assertEqual(len(data["replies"]), 1)
         self.assertEqual(data["replies"][0]["text"], "Reply comment")
 
+    def _build_thread(self, depth, width):
+        root = Comment.objects.create(user=self.user, text="Root")
+        level = [root]
+        for d in range(depth):
+            next_level = []
+            for parent in level:
+                for w in range(width):
+                    next_level.append(
+                        Comment.objects.create(
+                            user=self.user, text=f"Reply {d}-{w}", reply=parent
+                        )
+                    )
+            level = next_level
+        return root
+
+    def test_thread_serialization_query_count_is_flat(self):
+        """Тест что количество запросов не зависит от размера дерева"""
+        small = self._build_thread(depth=1, width=1)
+        big = self._build_thread(depth=4, width=3)
+
+        # Корень + поддерево + пользователи + вложения
+        with self.assertNumQueries(4):
+            small_data = CommentSerializer(Comment.objects.get(pk=small.pk)).data
+        with self.assertNumQueries(4):
+            big_data = CommentSerializer(Comment.objects.get(pk=big.pk)).data
+
+        self.assertEqual(len(small_data["replies"]), 1)
+        self.assertEqual(len(big_data["replies"]), 3)
+        self.assertEqual(len(big_data["replies"][0]["replies"][0]["replies"]), 3)
+
+    def test_thread_list_serialization_query_count(self):
+        """Тест загрузки нескольких деревьев одним запросом"""
+        self._build_thread(depth=2, width=2)
+        self._build_thread(depth=3, width=2)
+        roots = Comment.objects.filter(reply__isnull=True).select_related("user")
+
+        with self.assertNumQueries(4):
+            data = CommentSerializer(roots, many=True).data
+
+        self.assertEqual(len(data), 2)
+        self.assertTrue(all(len(item["replies"]) == 2 for item in data))
+
     def test_html_sanitization(self):
         """Тест санитизации HTML"""
         serializer = CommentCreateSerializer(
@@ -214,6 +393,339 @@ class CommentAPITest(APITestCase):
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]["text"], "Parent comment")
 
+    def _walk_cursor_pages(self, ordering):
+        url = f"/api/comments/?pagination=cursor&page_size=2&ordering={ordering}"
+        ids = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertFalse(
+                any("COUNT(" in q["sql"] or "OFFSET" in q["sql"] for q in queries)
+            )
+            ids += [item["id"] for item in response.data["results"]]
+            url = response.data["next"]
+        return ids
+
+    def test_cursor_pagination_orderings(self):
+        """Тест курсорной пагинации для всех вариантов сортировки"""
+        users = [self.user] + [
+            User.objects.create_user(
+                username=f"user{i}", email=f"{i}@example.com", password="pass"
+            )
+            for i in range(2)
+        ]
+        for i in range(7):
+            Comment.objects.create(user=users[i % 3], text=f"Comment {i}")
+
+        for ordering in [
+            "-created_at",
+            "created_at",
+            "user__username",
+            "-user__username",
+            "user__email",
+        ]:
+            expected = list(
+                Comment.objects.order_by(
+                    ordering, "-id" if ordering.startswith("-") else "id"
+                ).values_list("id", flat=True)
+            )
+            self.assertEqual(self._walk_cursor_pages(ordering), expected, ordering)
+
+    def test_cursor_pagination_invalid_cursor(self):
+        """Тест обработки некорректного курсора"""
+        response = self.client.get("/api/comments/?cursor=broken")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_pagination_invalid_cursor_values(self):
+        """Тест курсора с верной структурой, но неверными значениями"""
+        root = Comment.objects.create(user=self.user, text="Root")
+
+        def cursor(ordering, position):
+            payload = json.dumps({"o": ordering, "p": position}).encode()
+            return base64.urlsafe_b64encode(payload).decode()
+
+        for position in (
+            ["not-a-date", 1],
+            [None, 1],
+            ["2026-01-01T00:00:00+00:00", "abc"],
+            [[1], 2],
+            ["2026-01-01T00:00:00", 1],
+        ):
+            for url, ordering in (
+                ("/api/comments/", ["-created_at", "-id"]),
+                (f"/api/comments/{root.id}/replies/", ["created_at", "id"]),
+                ("/api/comments/preview/", ["-created_at", "-id"]),
+            ):
+                response = self.client.get(url, {"cursor": cursor(ordering, position)})
+                self.assertEqual(
+                    response.status_code, status.HTTP_404_NOT_FOUND, (url, position)
+                )
+
+    def test_depth_limited_replies(self):
+        """Тест ограничения глубины и количества ответов"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        children = [
+            Comment.objects.create(user=self.user, text=f"Child {i}", reply=root)
+            for i in range(3)
+        ]
+        for child in children:
+            for i in range(2):
+                Comment.objects.create(user=self.user, text=f"Deep {i}", reply=child)
+
+        response = self.client.get(f"/api/comments/{root.id}/?depth=1&replies_limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.data
+        self.assertEqual(
+            [r["id"] for r in data["replies"]], [c.id for c in children[:2]]
+        )
+        self.assertEqual(data["replies_count"], 3)
+        self.assertIsNotNone(data["replies_cursor"])
+        for reply in data["replies"]:
+            self.assertEqual(reply["replies"], [])
+            self.assertEqual(reply["replies_count"], 2)
+            self.assertIsNone(reply["replies_cursor"])
+
+        response = self.client.get(
+            f"/api/comments/{root.id}/replies/?depth=0&cursor={data['replies_cursor']}"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["id"] for r in response.data["results"]], [children[2].id])
+        self.assertIsNone(response.data["next"])
+
+    def test_default_thread_limits(self):
+        """Тест ограничений вложенности по умолчанию и их максимума"""
+        from app.utils import THREAD_PARAMS
+
+        depth, max_depth = THREAD_PARAMS["depth"]
+        limit, _ = THREAD_PARAMS["replies_limit"]
+        root = Comment.objects.create(user=self.user, text="Root")
+        for i in range(limit + 2):
+            Comment.objects.create(user=self.user, text=f"Child {i}", reply=root)
+        parent = root
+        for i in range(max_depth + 2):
+            parent = Comment.objects.create(user=self.user, text=f"{i}", reply=parent)
+
+        def levels(data):
+            count = 0
+            while data["replies"]:
+                data = data["replies"][-1]
+                count += 1
+            return count
+
+        for url in ("/api/comments/", f"/api/comments/{root.id}/"):
+            data = self.client.get(url).data
+            data = data["results"][0] if "results" in data else data
+            self.assertEqual(len(data["replies"]), limit, url)
+            self.assertEqual(data["replies_count"], limit + 3, url)
+            self.assertIsNotNone(data["replies_cursor"], url)
+
+        chain = self.client.get(f"/api/comments/{root.id}/", {"replies_limit": 100})
+        self.assertEqual(levels(chain.data), depth)
+        chain = self.client.get(
+            f"/api/comments/{root.id}/", {"replies_limit": 100, "depth": 1000}
+        )
+        self.assertEqual(levels(chain.data), max_depth)
+
+    def test_replies_endpoint_pagination(self):
+        """Тест постраничной загрузки ответов"""
+        root = Comment.objects.create(user=self.user, text="Root")
+        replies = [
+            Comment.objects.create(user=self.user, text=f"Reply {i}", reply=root)
+            for i in range(5)
+        ]
+
+        url = f"/api/comments/{root.id}/replies/?page_size=2"
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [r["id"] for r in response.data["results"]]
+            url = response.data["next"]
+
+        self.assertEqual(ids, [r.id for r in replies])
+        response = self.client.get("/api/comments/999/replies/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class QueryPlanTests(APITestCase):
+    """
+    Тесты планов запросов: EXPLAIN для каждого запроса API не должен
+    содержать последовательного чтения таблицы.
+
+    На PostgreSQL (PRODUCTION=True) seq scan отключается, поэтому план
+    с Seq Scan означает, что подходящего индекса нет.
+    """
+
+    def setUp(self):
+        users = [
+            User.objects.create_user(
+                username=f"user{i}", email=f"user{i}@example.com", password="pass"
+            )
+            for i in range(3)
+        ]
+        for i in range(30):
+            root = Comment.objects.create(user=users[i % 3], text=f"Root {i}")
+            for j in range(3):
+                reply = Comment.objects.create(
+                    user=users[j], text=f"Reply {j}", reply=root
+                )
+            Comment.objects.create(user=users[0], text="Nested", reply=reply)
+        self.root = root
+        self.reply = reply
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def _sequential_scans(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("EXPLAIN " + sql)
+                return [row[0] for row in cursor.fetchall() if "Seq Scan" in row[0]]
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return [
+                row[-1] for row in cursor.fetchall() if re.match(r"SCAN \S+$", row[-1])
+            ]
+
+    def test_api_queries_use_indexes(self):
+        """Тест что запросы всех представлений используют индексы"""
+        urls = [
+            "/api/comments/",
+            "/api/comments/preview/",
+            f"/api/comments/{self.root.id}/",
+            f"/api/comments/{self.reply.id}/",
+            f"/api/comments/{self.root.id}/replies/",
+            f"/api/comments/{self.root.id}/?depth=1&replies_limit=2",
+            "/api/comments/?search=Root",
+            "/api/comments/?search=user1",
+            "/api/comments/?search=Root&pagination=cursor&page_size=5",
+            "/api/comments/changes/",
+            f"/api/comments/changes/?thread={self.root.id}",
+            f"/api/comments/{self.root.id}/stream/",
+            f"/api/comments/{self.reply.id}/stream/",
+        ]
+        for ordering in [
+            "created_at",
+            "-created_at",
+            "last_activity_at",
+            "-last_activity_at",
+            "user__username",
+            "-user__email",
+        ]:
+            urls.append(f"/api/comments/?ordering={ordering}")
+            urls.append(f"/api/comments/?ordering={ordering}&pagination=cursor")
+
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+                if response.streaming:
+                    b"".join(response.streaming_content)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+            captured = queries.captured_queries
+
+            # Следующая страница курсорной пагинации
+            if "pagination=cursor" in url and response.data["next"]:
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(response.data["next"])
+                captured += queries.captured_queries
+
+            for query in captured:
+                if query["sql"].startswith("SELECT"):
+                    self.assertEqual(
+                        self._sequential_scans(query["sql"]), [], query["sql"]
+                    )
+
+
+class SearchTests(APITestCase):
+    """Тесты поиска по тексту комментария, имени и email автора"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="pass"
+        )
+        self.bob = User.objects.create_user(
+            username="bob", email="bob@mail.test", password="pass"
+        )
+        self.sparse = Comment.objects.create(
+            user=self.alice, text="<p>Apple pie with cinnamon and a lot of sugar</p>"
+        )
+        self.dense = Comment.objects.create(user=self.bob, text="Apple apple apple")
+        self.other = Comment.objects.create(user=self.bob, text="Banana bread")
+
+    def _search(self, query, **params):
+        response = self.client.get("/api/comments/", {"search": query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item["id"] for item in response.data["results"]]
+
+    def test_search_text_username_and_email(self):
+        """Тест поиска по тексту, имени пользователя и email"""
+        self.assertCountEqual(self._search("apple"), [self.sparse.id, self.dense.id])
+        self.assertEqual(self._search("cinnamon sugar"), [self.sparse.id])
+        self.assertCountEqual(self._search("bob"), [self.dense.id, self.other.id])
+        self.assertEqual(self._search("alice@example.com"), [self.sparse.id])
+        self.assertEqual(self._search("nothing"), [])
+
+    def test_search_results_are_ranked(self):
+        """Тест сортировки результатов по релевантности"""
+        self.assertEqual(self._search("apple"), [self.dense.id, self.sparse.id])
+        # Явная сортировка важнее релевантности
+        self.assertEqual(
+            self._search("apple", ordering="created_at"),
+            [self.sparse.id, self.dense.id],
+        )
+
+    def test_search_rank_ties_ordered_by_id(self):
+        """Тест устойчивого порядка при равной релевантности"""
+        self.assertEqual(self._search("bob"), [self.other.id, self.dense.id])
+        pages = [self._search("bob", page_size=1, page=page) for page in (1, 2)]
+        self.assertEqual(pages, [[self.other.id], [self.dense.id]])
+
+    def test_search_index_follows_writes(self):
+        """Тест обновления индекса при изменении комментариев и пользователей"""
+        self.dense.text = "Cherry"
+        self.dense.save()
+        self.assertEqual(self._search("apple"), [self.sparse.id])
+        self.assertEqual(self._search("cherry"), [self.dense.id])
+
+        self.alice.username = "carol"
+        self.alice.save()
+        self.assertEqual(self._search("alice"), [self.sparse.id])  # email
+        self.assertEqual(self._search("carol"), [self.sparse.id])
+
+        self.sparse.delete()
+        self.assertEqual(self._search("apple"), [])
+        # В списке ищутся только комментарии верхнего уровня
+        Comment.objects.create(user=self.bob, text="Durian", reply=self.other)
+        self.assertEqual(self._search("durian"), [])
+
+    def test_search_schema_survives_migrations(self):
+        """Тест что поисковый индекс и триггеры на месте после всех миграций"""
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+                self.assertLessEqual(
+                    {
+                        "app_comment_fts_insert",
+                        "app_comment_fts_update",
+                        "app_comment_fts_delete",
+                        "app_user_fts_update",
+                    },
+                    {row[0] for row in cursor.fetchall()},
+                )
+            else:
+                columns = connection.introspection.get_table_description(
+                    cursor, "app_comment"
+                )
+                self.assertIn("search_vector", [column.name for column in columns])
+                self.assertLessEqual(
+                    {"user_username_trgm_idx", "user_email_trgm_idx"},
+                    set(connection.introspection.get_constraints(cursor, "app_user")),
+                )
+
 
 class WebSocketConsumerTest(TestCase):
     """Тесты для WebSocket consumer"""
@@ -377,10 +889,17 @@ class CachingTests(APITestCase):
 
         cache.clear()
 
+    def _preview_page(self, page_size):
+        """Запись кеша страницы превью и признак её актуальности"""
+        from app.caching import AUTHORS, PREVIEW_LIST, get_entry
+
+        entry, version = get_entry(
+            f"comment_preview_list:{page_size}:", [PREVIEW_LIST, AUTHORS]
+        )
+        return entry, entry is not None and entry["version"] == version
+
     def test_comment_preview_caching(self):
         """Тест кеширования списка комментариев"""
-        from django.core.cache import cache
-
         # Создаём комментарий
         Comment.objects.create(user=self.user, text="Test comment 1")
 
@@ -388,12 +907,12 @@ class CachingTests(APITestCase):
         response1 = self.client.get("/api/comments/preview/")
         self.assertEqual(response1.status_code, status.HTTP_200_OK)
 
-        # Проверяем что данные закешированы
-        cached_data = cache.get("comment_preview_list")
-        self.assertIsNotNone(cached_data)
+        # Проверяем что страница закеширована
+        self.assertEqual(self._preview_page(25)[1], True)
 
-        # Второй запрос - данные из кеша
-        response2 = self.client.get("/api/comments/preview/")
+        # Второй запрос - данные из кеша, без запросов к БД
+        with self.assertNumQueries(0):
+            response2 = self.client.get("/api/comments/preview/")
         self.assertEqual(response2.status_code, status.HTTP_200_OK)
 
         # Данные должны быть одинаковыми
@@ -401,28 +920,32 @@ class CachingTests(APITestCase):
 
     def test_cache_invalidation_on_new_comment(self):
         """Тест инвалидации кеша при создании нового комментария"""
-        from django.core.cache import cache
-
         # Создаём первый комментарий
         Comment.objects.create(user=self.user, text="Comment 1")
 
         # Делаем запрос чтобы закешировать
         response1 = self.client.get("/api/comments/preview/")
-        self.assertEqual(len(response1.data), 1)
+        self.assertEqual(len(response1.data["results"]), 1)
 
         # Проверяем что кеш существует
-        self.assertIsNotNone(cache.get("comment_preview_list"))
+        self.assertEqual(self._preview_page(25)[1], True)
 
         # Создаём новый комментарий через API
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.access_token}")
-        self.client.post("/api/comments/", {"text": "Comment 2"})
+        with self.settings(RECAPTCHA_VERIFIER="app.recaptcha.StubRecaptchaVerifier"):
+            response = self.client.post(
+                "/api/comments/", {"text": "Comment 2", "recaptcha_token": "token"}
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
-        # Проверяем что кеш был очищен
-        self.assertIsNone(cache.get("comment_preview_list"))
+        # Страница устарела
+        entry, fresh = self._preview_page(25)
+        self.assertIsNotNone(entry)
+        self.assertFalse(fresh)
 
         # Новый запрос должен вернуть обновлённые данные
         response2 = self.client.get("/api/comments/preview/")
-        self.assertEqual(len(response2.data), 2)
+        self.assertEqual(len(response2.data["results"]), 2)
 
     def test_only_top_level_comments_cached(self):
         """Тест что кешируются только комментарии верхнего уровня"""
@@ -433,8 +956,1560 @@ class CachingTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
         # Должен быть только 1 комментарий (родительский)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]["text"], "Parent comment")
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["excerpt"], "Parent comment")
+
+    def test_preview_pages_cached_separately(self):
+        """Тест постраничного кеширования и короткого текста в превью"""
+        for i in range(5):
+            Comment.objects.create(
+                user=self.user, text=f"<p>Comment <b>{i}</b> &amp; " + "x" * 1500
+            )
+
+        response = self.client.get("/api/comments/preview/", {"page_size": 2})
+        first = response.data["results"]
+        self.assertEqual(len(first), 2)
+        self.assertNotIn("text", first[0])
+        self.assertTrue(first[0]["excerpt"].startswith("Comment 4 & xxx"))
+        self.assertLessEqual(len(first[0]["excerpt"]), 200)
+
+        pages = [self.client.get(response.data["next"])]
+        while pages[-1].data["next"]:
+            pages.append(self.client.get(pages[-1].data["next"]))
+        seen = [
+            item["id"] for page in [response] + pages for item in page.data["results"]
+        ]
+        self.assertEqual(
+            seen,
+            list(
+                Comment.objects.order_by("-created_at", "-id").values_list(
+                    "id", flat=True
+                )
+            ),
+        )
+
+        # Каждая страница лежит в кеше под своим ключом
+        self.assertEqual(self._preview_page(2)[1], True)
+        with self.assertNumQueries(0):
+            for page in pages:
+                self.assertEqual(
+                    self.client.get(page.wsgi_request.get_full_path()).data, page.data
+                )
+
+
+class CacheInvalidationTests(TestCase):
+    """Тесты инвалидации кеша по поколениям тегов"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="author", email="author@example.com", password="pass"
+        )
+        self.root = Comment.objects.create(user=self.user, text="Root")
+
+    def _changed(self, *tags):
+        """Какие из тегов сменили поколение с прошлого вызова"""
+        from app.caching import get_generations
+
+        current = dict(zip(tags, get_generations(*tags)))
+        previous, self._seen = getattr(self, "_seen", {}), current
+        return {tag for tag in tags if previous.get(tag, current[tag]) != current[tag]}
+
+    def test_comment_and_attachment_signals(self):
+        """Тест смены поколений при изменениях комментариев и вложений"""
+        from app.caching import AUTHORS, COMMENTS_LIST, PREVIEW_LIST, thread_tag
+        from app.models import CommentAttachment
+
+        other = Comment.objects.create(user=self.user, text="Other thread")
+        tags = (
+            thread_tag(self.root.id),
+            thread_tag(other.id),
+            AUTHORS,
+            COMMENTS_LIST,
+            PREVIEW_LIST,
+        )
+        self._changed(*tags)
+        reply_tags = {thread_tag(self.root.id), COMMENTS_LIST}
+
+        reply = Comment.objects.create(user=self.user, text="Reply", reply=self.root)
+        self.assertEqual(self._changed(*tags), reply_tags)
+
+        reply.text = "Edited"
+        reply.save()
+        self.assertEqual(self._changed(*tags), reply_tags)
+
+        attachment = CommentAttachment.objects.create(
+            comment=reply, file="https://example.com/a.txt", media_type="file"
+        )
+        self.assertEqual(self._changed(*tags), reply_tags)
+        attachment.delete()
+        self.assertEqual(self._changed(*tags), reply_tags)
+
+        self.root.text = "Edited root"
+        self.root.save()
+        self.assertEqual(self._changed(*tags), reply_tags | {PREVIEW_LIST})
+
+        reply.delete()
+        self.assertEqual(self._changed(*tags), reply_tags | {PREVIEW_LIST})
+
+    def test_user_signals(self):
+        """Тест инвалидации авторов при смене имени, но не при входе"""
+        from django.contrib.auth.models import update_last_login
+
+        from app.caching import AUTHORS, thread_tag
+
+        tags = (thread_tag(self.root.id), AUTHORS)
+        self._changed(*tags)
+
+        update_last_login(None, self.user)
+        self.assertEqual(self._changed(*tags), set())
+
+        self.user.username = "renamed"
+        self.user.save()
+        self.assertEqual(self._changed(*tags), {AUTHORS})
+
+        self.user.email = "renamed@example.com"
+        self.user.save(update_fields=["email"])
+        self.assertEqual(self._changed(*tags), {AUTHORS})
+
+
+class StampedeProtectionTests(TestCase):
+    """Тесты защиты кеша от одновременного пересчёта"""
+
+    key = "stampede-test"
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.calls = 0
+
+    def _compute(self, value="fresh", delay=0):
+        import time
+
+        def compute():
+            self.calls += 1
+            time.sleep(delay)
+            return value
+
+        return compute
+
+    def test_concurrent_misses_compute_once(self):
+        """Тест что одновременные промахи пересчитывают значение один раз"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        from app.caching import cached
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(
+                pool.map(lambda _: cached(self.key, self._compute(delay=0.3)), range(8))
+            )
+        self.assertEqual(results, ["fresh"] * 8)
+        self.assertEqual(self.calls, 1)
+
+    def test_stale_value_served_while_recomputing(self):
+        """Тест что устаревшее значение отдаётся, пока другой процесс пересчитывает"""
+        from app.caching import cached, invalidate, locked, thread_tag
+
+        tags = [thread_tag(1)]
+        cached(self.key, self._compute("old"), tags=tags)
+        invalidate(*tags)
+
+        with locked(self.key) as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(cached(self.key, self._compute(), tags=tags), "old")
+        self.assertEqual(cached(self.key, self._compute(), tags=tags), "fresh")
+        self.assertEqual(self.calls, 2)
+
+    def test_probabilistic_early_refresh(self):
+        """Тест раннего пересчёта незадолго до истечения (XFetch)"""
+        from unittest.mock import patch
+
+        from app.caching import cached, store
+
+        store(self.key, "old", version="", timeout=1, delta=0.5)
+        with patch("app.caching.random.random", return_value=0.0):
+            self.assertEqual(cached(self.key, self._compute()), "old")
+        with patch("app.caching.random.random", return_value=0.99):
+            self.assertEqual(cached(self.key, self._compute()), "fresh")
+        self.assertEqual(self.calls, 1)
+
+
+class TwoTierCacheTests(APITestCase):
+    """Тесты двухуровневого кеша (память процесса + Redis)"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.cache = cache
+
+    def test_reads_served_from_memory(self):
+        """Тест что повторное чтение не обращается к Redis"""
+        from unittest.mock import patch
+
+        self.cache.set("l1-key", {"value": 1})
+        self.assertEqual(self.cache.get("l1-key"), {"value": 1})
+
+        with patch.object(self.cache._cache, "get", side_effect=AssertionError):
+            self.assertEqual(self.cache.get("l1-key"), {"value": 1})
+            self.assertEqual(self.cache.get_many(["l1-key"]), {"l1-key": {"value": 1}})
+
+    def test_excluded_keys_always_read_from_redis(self):
+        """Тест что поколения и блокировки не кешируются в памяти"""
+        self.cache.set("generation:thread:1", 1)
+        self.cache.set("modified:thread:1", 1)
+        self.cache.set("thread:1:lock", 1)
+        self.cache.get("generation:thread:1")
+        self.cache.get_many(["modified:thread:1", "thread:1:lock"])
+        for key in ("generation:thread:1", "modified:thread:1", "thread:1:lock"):
+            self.assertNotIn(self.cache.make_and_validate_key(key), self.cache.local)
+
+        # Другой процесс изменил поколение без сообщения об инвалидации
+        client = self.cache._cache.get_client(write=True)
+        client.set(
+            self.cache.make_and_validate_key("generation:thread:1"),
+            self.cache._cache._serializer.dumps(2),
+        )
+        self.assertEqual(self.cache.get("generation:thread:1"), 2)
+        self.assertEqual(
+            self.cache.get_many(["generation:thread:1"]), {"generation:thread:1": 2}
+        )
+        self.assertTrue(self.cache.has_key("generation:thread:1"))
+        client.delete(self.cache.make_and_validate_key("generation:thread:1"))
+        self.assertFalse(self.cache.has_key("generation:thread:1"))
+
+    def test_excluded_keys_not_broadcast(self):
+        """Тест что запись поколений и блокировок не рассылает инвалидацию"""
+        from unittest.mock import patch
+
+        self.cache.set("l1-key", 1)
+        self.cache.get("l1-key")
+        epoch = self.cache.local.epoch
+        client = self.cache._cache.get_client(write=True)
+        with patch.object(type(client), "publish") as publish:
+            self.cache.set("generation:thread:1", 1)
+            self.cache.incr("generation:thread:1")
+            self.cache.add("thread:1:lock", 1)
+            self.cache.delete("thread:1:lock")
+            self.cache.set_many({"modified:thread:1": 1})
+        publish.assert_not_called()
+        self.assertEqual(self.cache.local.epoch, epoch)
+        self.assertEqual(self.cache.get("l1-key"), 1)
+
+    def test_writes_invalidate_memory(self):
+        """Тест что запись сбрасывает значение в памяти"""
+        self.cache.set("l1-key", 1)
+        self.assertEqual(self.cache.get("l1-key"), 1)
+        self.cache.incr("l1-key")
+        self.assertEqual(self.cache.get("l1-key"), 2)
+        self.cache.delete("l1-key")
+        self.assertIsNone(self.cache.get("l1-key"))
+
+    def test_invalidation_broadcast_from_other_worker(self):
+        """Тест сброса значения в памяти по сообщению от другого процесса"""
+        import time
+
+        self.cache.set("l1-key", 1)
+        self.cache.get("l1-key")
+        key = self.cache.make_and_validate_key("l1-key")
+        self.assertIn(key, self.cache.local)
+
+        # Другой процесс изменил ключ напрямую в Redis
+        client = self.cache._cache.get_client(write=True)
+        client.set(key, self.cache._cache._serializer.dumps(2))
+        client.publish(
+            self.cache.channel, json.dumps({"origin": "other", "keys": [key]})
+        )
+
+        deadline = time.monotonic() + 5
+        while key in self.cache.local and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.cache.get("l1-key"), 2)
+
+    def test_metrics_endpoint(self):
+        """Тест эндпоинта метрик: только для администраторов"""
+        user = User.objects.create_user(username="user", password="pass")
+        admin = User.objects.create_user(
+            username="admin", password="pass", is_staff=True
+        )
+        self.cache.set("l1-key", 1)
+        self.cache.get("l1-key")
+        self.cache.get("l1-key")
+        self.cache.get("missing")
+
+        self.client.force_authenticate(user)
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(admin)
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = response.data["cache"]
+        self.assertGreaterEqual(stats["l1"]["hits"], 1)
+        self.assertGreaterEqual(stats["l2"]["hits"], 1)
+        self.assertGreaterEqual(stats["l2"]["misses"], 1)
+        self.assertTrue(0 < stats["l1"]["hit_rate"] < 1)
+
+
+class ThreadCacheTests(APITestCase):
+    """Тесты кеширования веток в виде готового JSON"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="author", email="author@example.com", password="pass"
+        )
+        self.root = Comment.objects.create(user=self.user, text="Root")
+        self.reply = Comment.objects.create(
+            user=self.user, text="Reply", reply=self.root
+        )
+        self.url = f"/api/comments/{self.root.id}/"
+
+    def _fresh_thread(self):
+        root = Comment.objects.get(pk=self.root.pk)
+        return json.loads(json.dumps(CommentSerializer(root).data))
+
+    def test_thread_served_from_cache(self):
+        """Тест что повторный запрос ветки не обращается к БД"""
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second["Content-Type"], "application/json")
+        self.assertEqual(second.data, self._fresh_thread())
+
+        # Параметры глубины и ответы не из кеша
+        self.assertEqual(self.client.get(self.url, {"depth": 0}).data["replies"], [])
+        self.assertEqual(
+            self.client.get(f"/api/comments/{self.reply.id}/").data["id"],
+            self.reply.id,
+        )
+
+    def test_new_reply_patches_cached_thread(self):
+        """Тест что новый ответ дописывается в закешированную ветку"""
+        self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            nested = Comment.objects.create(
+                user=self.user, text="Nested", reply=self.reply
+            )
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(user=self.user, text="Second", reply=self.root)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data, self._fresh_thread())
+        self.assertEqual(response.data["replies"][0]["replies"][0]["id"], nested.id)
+        self.assertEqual(response.data["descendant_count"], 3)
+
+    def test_changes_invalidate_cached_thread(self):
+        """Тест что правка и удаление сбрасывают закешированную ветку"""
+        self.client.get(self.url)
+
+        self.reply.text = "Edited"
+        self.reply.save()
+        self.assertEqual(self.client.get(self.url).data, self._fresh_thread())
+
+        self.reply.delete()
+        self.assertEqual(self.client.get(self.url).data["replies"], [])
+
+    def test_misses_not_cached(self):
+        """Тест что ответы и несуществующие id не попадают в кеш веток"""
+        from django.core.cache import cache
+
+        from app.thread_cache import _document_key, get_document, rebuild_document
+
+        missing = self.reply.id + 100
+        self.assertEqual(self.client.get(f"/api/comments/{missing}/").status_code, 404)
+        self.assertEqual(
+            self.client.get(f"/api/comments/{self.reply.id}/").status_code, 200
+        )
+        self.assertIsNone(get_document(self.reply.id))
+        self.assertTrue(rebuild_document(missing))
+        for comment_id in (self.reply.id, missing):
+            self.assertIsNone(cache.get(_document_key(comment_id)))
+
+    def test_patch_respects_thread_limits(self):
+        """Тест что дописывание ответа соблюдает ограничения вложенности"""
+        from unittest.mock import patch
+
+        from app import thread_cache
+
+        def reply(text, parent):
+            with self.captureOnCommitCallbacks(execute=True):
+                return Comment.objects.create(user=self.user, text=text, reply=parent)
+
+        limits = {"max_depth": 2, "replies_limit": 2}
+        with (
+            patch.dict(thread_cache.LIMITS, limits),
+            patch("app.tasks.render_thread_document.delay") as render,
+        ):
+            self.client.get(self.url)
+            reply("Second", self.root)
+            nested = reply("Nested", self.reply)
+            render.assert_not_called()
+
+            # Третий ответ впервые не помещается: ветка перестраивается
+            reply("Third", self.root)
+            render.assert_called_once_with(self.root.id)
+            thread_cache.rebuild_document(self.root.id)
+            render.reset_mock()
+
+            # Дальше меняются только счётчики
+            reply("Fourth", self.root)
+            reply("Deep", nested)
+            render.assert_not_called()
+
+            with self.assertNumQueries(0):
+                response = self.client.get(self.url)
+            root = Comment.objects.get(pk=self.root.pk)
+            fresh = CommentSerializer(root, context=thread_cache.LIMITS).data
+        self.assertEqual(response.data, json.loads(json.dumps(fresh)))
+        self.assertEqual(response.data["replies_count"], 4)
+        self.assertEqual(len(response.data["replies"]), 2)
+
+    def test_unpatchable_thread_rebuilt_in_background(self):
+        """Тест фоновой перестройки ветки, если её нельзя дописать"""
+        from unittest.mock import patch
+
+        from app.models import CommentAttachment
+
+        self.client.get(self.url)
+
+        with patch("app.tasks.render_thread_document.delay") as render:
+            with self.captureOnCommitCallbacks(execute=True):
+                reply = Comment.objects.create(
+                    user=self.user, text="With file", reply=self.root
+                )
+                CommentAttachment.objects.create(
+                    comment=reply, file="https://example.com/a.txt", media_type="file"
+                )
+        render.assert_called_once_with(self.root.id)
+
+        from app.tasks import render_thread_document
+
+        render_thread_document(self.root.id)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data, self._fresh_thread())
+
+        # Холодные ветки не перестраиваются
+        other = Comment.objects.create(user=self.user, text="Cold")
+        with patch("app.tasks.render_thread_document.delay") as render:
+            with self.captureOnCommitCallbacks(execute=True):
+                Comment.objects.create(user=self.user, text="Reply", reply=other)
+        render.assert_not_called()
+
+
+class ConditionalGetTests(APITestCase):
+    """Тесты условных GET-запросов (ETag / Last-Modified)"""
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.user = User.objects.create_user(username="author", password="pass")
+        self.root = Comment.objects.create(user=self.user, text="Root")
+        self.reply = Comment.objects.create(
+            user=self.user, text="Reply", reply=self.root
+        )
+
+    def _revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+
+    def test_list_not_modified(self):
+        """Тест ответа 304 для неизменившегося списка"""
+        url = "/api/comments/"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("Last-Modified", response)
+
+        with self.assertNumQueries(0):
+            not_modified = self._revalidate(url, response)
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(not_modified.content, b"")
+
+        # Другие параметры - другой ETag
+        other = self.client.get(url, {"ordering": "created_at"})
+        self.assertNotEqual(other["ETag"], response["ETag"])
+
+        Comment.objects.create(user=self.user, text="New", reply=self.reply)
+        self.assertEqual(self._revalidate(url, response).status_code, 200)
+
+    def test_detail_not_modified(self):
+        """Тест ответа 304 для неизменившейся ветки и вложенного комментария"""
+        for comment in (self.root, self.reply):
+            url = f"/api/comments/{comment.id}/"
+            response = self.client.get(url)
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    self._revalidate(url, response).status_code,
+                    status.HTTP_304_NOT_MODIFIED,
+                )
+            self.assertEqual(
+                self.client.get(
+                    url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+                ).status_code,
+                status.HTTP_304_NOT_MODIFIED,
+            )
+
+        # Любое изменение в ветке меняет ETag всех её комментариев
+        url = f"/api/comments/{self.reply.id}/"
+        response = self.client.get(url)
+        Comment.objects.create(user=self.user, text="Sibling", reply=self.root)
+        self.assertEqual(self._revalidate(url, response).status_code, 200)
+
+    def test_deleted_parent_moves_comment_to_new_thread(self):
+        """Тест что после удаления родителя комментарий получает новую ветку"""
+        from app.threads import cached_thread_id
+
+        nested = Comment.objects.create(user=self.user, text="Nested", reply=self.reply)
+        self.assertEqual(cached_thread_id(nested.id), self.root.id)
+
+        url = f"/api/comments/{nested.id}/"
+        response = self.client.get(url)
+        self.reply.delete()
+
+        self.assertEqual(cached_thread_id(nested.id), nested.id)
+        self.assertEqual(self._revalidate(url, response).status_code, 200)
+        self.assertEqual(
+            self.client.get(f"/api/comments/{self.reply.id}/").status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+
+class ChangesSyncTests(APITestCase):
+    """Тесты дельта-синхронизации комментариев"""
+
+    url = "/api/comments/changes/"
+
+    def setUp(self):
+        from unittest.mock import patch
+
+        # Без задержки на незакоммиченные транзакции
+        patcher = patch("app.sync.SETTLE_TIME", timedelta(0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user(username="author", password="pass")
+        self.root = Comment.objects.create(user=self.user, text="Root")
+        self.reply = Comment.objects.create(
+            user=self.user, text="Reply", reply=self.root
+        )
+
+    def _sync(self, since=None, **params):
+        if since:
+            params["since"] = since
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_initial_sync_returns_everything(self):
+        """Тест первой синхронизации без курсора"""
+        data = self._sync()
+        self.assertEqual(
+            [c["id"] for c in data["changed"]], [self.root.id, self.reply.id]
+        )
+        self.assertEqual(data["changed"][1]["thread"], self.root.id)
+        self.assertEqual(data["deleted"], [])
+        self.assertFalse(data["has_more"])
+
+        # Повторный запрос с курсором ничего не возвращает
+        again = self._sync(data["cursor"])
+        self.assertEqual(again["changed"], [])
+        self.assertEqual(again["deleted"], [])
+
+    def test_changes_and_deletions_since_cursor(self):
+        """Тест изменений, вложений и удалений после курсора"""
+        cursor = self._sync()["cursor"]
+
+        self.root.text = "Edited"
+        self.root.save()
+        CommentAttachment.objects.create(
+            comment=self.reply, file="https://example.com/a.png", media_type="image"
+        )
+        data = self._sync(cursor)
+        self.assertEqual(
+            [c["id"] for c in data["changed"]], [self.root.id, self.reply.id]
+        )
+        self.assertEqual(len(data["changed"][1]["attachments"]), 1)
+
+        reply_id = self.reply.id
+        self.reply.delete()
+        data = self._sync(data["cursor"])
+        self.assertEqual(data["deleted"], [reply_id])
+
+    def test_detached_replies_are_reported(self):
+        """Тест что ответы удалённого комментария возвращаются как изменённые"""
+        nested = Comment.objects.create(user=self.user, text="Nested", reply=self.reply)
+        cursor = self._sync()["cursor"]
+
+        reply_id = self.reply.id
+        self.reply.delete()
+        data = self._sync(cursor)
+        self.assertEqual([c["id"] for c in data["changed"]], [nested.id])
+        self.assertEqual(data["changed"][0]["thread"], nested.id)
+        self.assertEqual(data["deleted"], [reply_id])
+
+    def test_moved_replies_leave_old_thread(self):
+        """Тест надгробий для ответов, перенесённых из ветки"""
+        nested = Comment.objects.create(user=self.user, text="Nested", reply=self.reply)
+        leaf = Comment.objects.create(user=self.user, text="Leaf", reply=nested)
+        cursor = self._sync(thread=self.root.id)["cursor"]
+
+        reply_id = self.reply.id
+        self.reply.delete()
+        data = self._sync(cursor, thread=self.root.id)
+        self.assertEqual(data["changed"], [])
+        self.assertCountEqual(data["deleted"], [reply_id, nested.id, leaf.id])
+
+        # В новой ветке они появляются как изменённые
+        data = self._sync(thread=nested.id)
+        self.assertEqual([c["id"] for c in data["changed"]], [nested.id, leaf.id])
+
+    def test_pages_follow_cursor(self):
+        """Тест постраничной выдачи по курсору"""
+        for i in range(3):
+            Comment.objects.create(user=self.user, text=f"Reply {i}", reply=self.root)
+
+        seen, cursor, has_more = [], None, True
+        while has_more:
+            data = self._sync(cursor, limit=2)
+            seen += [c["id"] for c in data["changed"]]
+            cursor, has_more = data["cursor"], data["has_more"]
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), Comment.objects.count())
+
+    def test_thread_filter(self):
+        """Тест синхронизации одной ветки"""
+        other = Comment.objects.create(user=self.user, text="Other")
+        data = self._sync(thread=self.root.id)
+        self.assertEqual(
+            [c["id"] for c in data["changed"]], [self.root.id, self.reply.id]
+        )
+
+        other.delete()
+        data = self._sync(data["cursor"], thread=self.root.id)
+        self.assertEqual(data["deleted"], [])
+
+    def test_expired_and_invalid_cursor(self):
+        """Тест устаревшего и повреждённого курсора"""
+        from app.sync import TOMBSTONE_RETENTION, encode_cursor
+
+        old = timezone.now() - TOMBSTONE_RETENTION - timedelta(days=1)
+        response = self.client.get(
+            self.url, {"since": encode_cursor((old, 0), (old, 0))}
+        )
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+        response = self.client.get(self.url, {"since": "garbage"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # Метка времени без часового пояса
+        naive = datetime(2026, 1, 1)
+        response = self.client.get(
+            self.url, {"since": encode_cursor((naive, 0), (naive, 0))}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_purge_tombstones(self):
+        """Тест удаления старых надгробий"""
+        from app.sync import TOMBSTONE_RETENTION
+        from app.tasks import purge_comment_tombstones
+
+        self.reply.delete()
+        CommentTombstone.objects.update(
+            deleted_at=timezone.now() - TOMBSTONE_RETENTION - timedelta(days=1)
+        )
+        root_id = self.root.id
+        self.root.delete()
+
+        self.assertEqual(purge_comment_tombstones(), 1)
+        self.assertEqual(
+            list(CommentTombstone.objects.values_list("comment_id", flat=True)),
+            [root_id],
+        )
+
+
+class StreamingTests(APITestCase):
+    """Тесты потоковой выдачи веток и экспорта"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="author", password="pass")
+        self.root = Comment.objects.create(user=self.user, text="Root")
+        self.first = Comment.objects.create(
+            user=self.user, text="First", reply=self.root
+        )
+        self.nested = Comment.objects.create(
+            user=self.user, text="Nested", reply=self.first
+        )
+        self.second = Comment.objects.create(
+            user=self.user, text="Second", reply=self.root
+        )
+        CommentAttachment.objects.create(
+            comment=self.nested, file="https://example.com/a.png", media_type="image"
+        )
+
+    def _stream(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/json")
+        return json.loads(b"".join(response.streaming_content))
+
+    def _tree(self, node):
+        return [node["id"], [self._tree(child) for child in node["replies"]]]
+
+    def test_stream_thread(self):
+        """Тест вложенной ветки в потоке"""
+        data = self._stream(f"/api/comments/{self.root.id}/stream/")
+        self.assertEqual(
+            self._tree(data),
+            [
+                self.root.id,
+                [[self.first.id, [[self.nested.id, []]]], [self.second.id, []]],
+            ],
+        )
+        self.assertEqual(data["user"]["username"], "author")
+        self.assertEqual(data["descendant_count"], 3)
+        nested = data["replies"][0]["replies"][0]
+        self.assertEqual(len(nested["attachments"]), 1)
+
+        # Поддерево ответа
+        data = self._stream(f"/api/comments/{self.first.id}/stream/")
+        self.assertEqual(self._tree(data), [self.first.id, [[self.nested.id, []]]])
+
+    def test_stream_deep_thread(self):
+        """Тест глубокой ветки: рекурсии нет, все уровни закрываются"""
+        parent = self.second
+        for i in range(50):
+            parent = Comment.objects.create(user=self.user, text=f"{i}", reply=parent)
+
+        data = self._stream(f"/api/comments/{self.second.id}/stream/")
+        depth = 0
+        while data["replies"]:
+            data = data["replies"][0]
+            depth += 1
+        self.assertEqual(depth, 50)
+        self.assertEqual(data["id"], parent.id)
+
+    def test_stream_in_chunks(self):
+        """Тест чтения строк частями"""
+        from unittest.mock import patch
+
+        with patch("app.streaming.CHUNK_SIZE", 2):
+            with CaptureQueriesContext(connection) as queries:
+                self._stream(f"/api/comments/{self.root.id}/stream/")
+        attachment_queries = [
+            q for q in queries.captured_queries if "app_commentattachment" in q["sql"]
+        ]
+        self.assertEqual(len(attachment_queries), 2)
+
+    def test_export(self):
+        """Тест экспорта всех комментариев"""
+        response = self.client.get("/api/comments/export/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.client.force_authenticate(self.user)
+        response = self.client.get("/api/comments/export/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        admin = User.objects.create_superuser(username="admin", password="pass")
+        self.client.force_authenticate(admin)
+        response = self.client.get("/api/comments/export/")
+        self.assertIn("attachment", response["Content-Disposition"])
+        data = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(
+            [c["id"] for c in data],
+            [self.root.id, self.first.id, self.nested.id, self.second.id],
+        )
+        self.assertEqual(data[1]["thread"], self.root.id)
+
+    async def test_stream_under_asgi(self):
+        """Тест потока под ASGI: асинхронный итератор, без чтения в список"""
+        import warnings
+        from unittest.mock import patch
+
+        with patch("app.streaming.CHUNK_SIZE", 2):
+            response = await self.async_client.get(
+                f"/api/comments/{self.root.id}/stream/"
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_async)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                chunks = [chunk async for chunk in response]
+        self.assertEqual(caught, [])
+        self.assertGreater(len(chunks), 1)
+        data = json.loads(b"".join(chunks))
+        self.assertEqual(
+            self._tree(data),
+            [
+                self.root.id,
+                [[self.first.id, [[self.nested.id, []]]], [self.second.id, []]],
+            ],
+        )
+
+    def test_stream_missing_comment(self):
+        """Тест потока несуществующего комментария"""
+        response = self.client.get("/api/comments/999999/stream/")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class JSONRenderingTests(TestCase):
+    """Тесты рендерера и парсера на orjson"""
+
+    def test_renderer_matches_drf(self):
+        """Тест совпадения вывода с JSONRenderer из DRF"""
+        import datetime
+        import decimal
+        import uuid
+
+        from django.utils.translation import gettext_lazy
+        from rest_framework.renderers import JSONRenderer
+
+        from app.renderers import ORJSONRenderer
+
+        data = {
+            "text": "Ünïcödé \u2028 <b>",
+            "created_at": datetime.datetime(
+                2026, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc
+            ),
+            "date": datetime.date(2026, 1, 2),
+            "amount": decimal.Decimal("1.50"),
+            "uuid": uuid.UUID(int=1),
+            "lazy": gettext_lazy("Comment"),
+            "nested": [{"id": 1, "replies": []}],
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(None), b"")
+
+    def test_parser(self):
+        """Тест разбора и ошибки разбора"""
+        import io
+
+        from rest_framework.exceptions import ParseError
+
+        from app.parsers import ORJSONParser
+
+        parser = ORJSONParser()
+        self.assertEqual(parser.parse(io.BytesIO(b'{"text": "a"}')), {"text": "a"})
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b"{not json"))
+
+    def test_api_uses_orjson(self):
+        """Тест JSON в API: ответ и ошибка разбора тела запроса"""
+        user = User.objects.create_user(username="author", password="pass")
+        Comment.objects.create(user=user, text="Root")
+        response = self.client.get("/api/comments/")
+        self.assertEqual(response.json()["results"][0]["text"], "Root")
+
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(
+            "/api/comments/", b"{not json", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_benchmark_command(self):
+        """Тест команды сравнения рендереров"""
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command(
+            "benchmark_json", threads=2, replies=2, depth=2, iterations=1, stdout=out
+        )
+        for name in ("render", "parse", "broadcast"):
+            self.assertIn(name, out.getvalue())
+
+
+class MessagePackTests(APITestCase):
+    """Тесты формата MessagePack в API и WebSocket"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="author", password="pass")
+        self.root = Comment.objects.create(user=self.user, text="Root ü")
+        Comment.objects.create(user=self.user, text="Reply", reply=self.root)
+
+    def _unpack(self, response):
+        import msgpack
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        return msgpack.unpackb(response.content)
+
+    def test_round_trip_matches_json(self):
+        """Тест что MessagePack содержит те же данные, что и JSON"""
+        for url in [
+            "/api/comments/",
+            "/api/comments/preview/",
+            f"/api/comments/{self.root.id}/",
+            f"/api/comments/{self.root.id}/replies/",
+            "/api/comments/changes/",
+        ]:
+            as_json = json.loads(
+                self.client.get(url, HTTP_ACCEPT="application/json").content
+            )
+            packed = self._unpack(
+                self.client.get(url, HTTP_ACCEPT="application/msgpack")
+            )
+            # Курсор синхронизации зависит от времени запроса
+            as_json.pop("cursor", None)
+            packed.pop("cursor", None)
+            self.assertEqual(packed, as_json, url)
+
+    def test_etag_depends_on_format(self):
+        """Тест разных ETag для JSON и MessagePack"""
+        url = f"/api/comments/{self.root.id}/"
+        as_json = self.client.get(url, HTTP_ACCEPT="application/json")
+        packed = self.client.get(url, HTTP_ACCEPT="application/msgpack")
+        self.assertNotEqual(packed["ETag"], as_json["ETag"])
+
+        # Общие кеши не должны отдавать один формат вместо другого
+        not_modified = self.client.get(
+            url, HTTP_ACCEPT="application/msgpack", HTTP_IF_NONE_MATCH=packed["ETag"]
+        )
+        self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+        for response in (
+            as_json,
+            packed,
+            not_modified,
+            self.client.get("/api/comments/"),
+        ):
+            self.assertIn("Accept", response["Vary"])
+
+    def test_format_query_param(self):
+        """Тест выбора формата параметром ?format=msgpack"""
+        response = self.client.get("/api/comments/", {"format": "msgpack"})
+        self.assertEqual(self._unpack(response)["count"], 1)
+
+    def test_streams_are_json_only(self):
+        """Тест что потоковые ответы не отдаются в MessagePack"""
+        response = self.client.get(
+            f"/api/comments/{self.root.id}/stream/", HTTP_ACCEPT="application/msgpack"
+        )
+        self.assertEqual(response.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+
+    def test_parser(self):
+        """Тест разбора тела в MessagePack"""
+        import io
+
+        import msgpack
+        from rest_framework.exceptions import ParseError
+
+        from app.parsers import MessagePackParser
+
+        parser = MessagePackParser()
+        body = msgpack.packb({"text": "Hi", "reply": None})
+        self.assertEqual(parser.parse(io.BytesIO(body)), {"text": "Hi", "reply": None})
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b"\xc1"))
+
+    async def test_websocket_binary_frames(self):
+        """Тест бинарных кадров для подпротокола msgpack"""
+        import msgpack
+
+        communicator = WebsocketCommunicator(
+            ReplyConsumer.as_asgi(), "/ws/comments/1/", subprotocols=["msgpack"]
+        )
+        communicator.scope["user"] = self.user
+        communicator.scope["url_route"] = {"kwargs": {"comment_name": "1"}}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, "msgpack")
+
+        reply = {"id": 1, "text": "Test reply ü", "user": {"username": "author"}}
+        await get_channel_layer().group_send(
+            "comment_1", {"type": "new_reply", "reply": reply}
+        )
+        frame = await communicator.receive_output()
+        self.assertIsNone(frame.get("text"))
+        self.assertEqual(
+            msgpack.unpackb(frame["bytes"]), {"type": "new_reply", "data": reply}
+        )
+        await communicator.disconnect()
+
+
+class RecaptchaVerifierTests(TestCase):
+    """Тесты проверки reCAPTCHA"""
+
+    def _serializer(self, token):
+        return CommentCreateSerializer(data={"text": "Hello", "recaptcha_token": token})
+
+    def _stub_server(self):
+        import threading
+        from http.server import ThreadingHTTPServer
+
+        from app.management.commands.benchmark_recaptcha import (
+            StubSiteverifyHandler,
+        )
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubSiteverifyHandler)
+        server.daemon_threads = True
+        server.latency = 0
+        server.connections = 0
+        server.lock = threading.Lock()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_stub_verifier(self):
+        """Тест подменяемого верификатора"""
+        from app.recaptcha import StubRecaptchaVerifier
+
+        with self.settings(RECAPTCHA_VERIFIER="app.recaptcha.StubRecaptchaVerifier"):
+            self.assertTrue(self._serializer("token").is_valid())
+            serializer = self._serializer(StubRecaptchaVerifier.INVALID_TOKEN)
+            self.assertFalse(serializer.is_valid())
+            self.assertIn("recaptcha_token", serializer.errors)
+
+    def test_google_verifier_reuses_connections(self):
+        """Тест что проверки идут через одно keep-alive соединение"""
+        server = self._stub_server()
+        url = f"http://127.0.0.1:{server.server_port}/siteverify"
+
+        with self.settings(RECAPTCHA_VERIFY_URL=url):
+            for _ in range(3):
+                self.assertTrue(self._serializer("token").is_valid())
+        self.assertEqual(server.connections, 1)
+
+    def test_unavailable_verifier(self):
+        """Тест недоступного сервиса проверки"""
+        server = self._stub_server()
+        url = f"http://127.0.0.1:{server.server_port}/missing"
+        server.shutdown()
+        server.server_close()
+
+        with self.settings(RECAPTCHA_VERIFY_URL=url, RECAPTCHA_TIMEOUT=1):
+            serializer = self._serializer("token")
+            self.assertFalse(serializer.is_valid())
+        self.assertIn("could not be verified", str(serializer.errors))
+
+    def test_benchmark_command(self):
+        """Тест команды замера пропускной способности"""
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command(
+            "benchmark_recaptcha", requests=4, concurrency=2, latency=0, stdout=out
+        )
+        self.assertIn("pooled", out.getvalue())
+        self.assertIn("unpooled", out.getvalue())
+
+
+class AttachmentPipelineTests(APITestCase):
+    """Тесты фоновой обработки вложений"""
+
+    def setUp(self):
+        import tempfile
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.media_root = media_root.name
+        settings = self.settings(
+            MEDIA_ROOT=media_root.name,
+            RECAPTCHA_VERIFIER="app.recaptcha.StubRecaptchaVerifier",
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.user = User.objects.create_user(username="author", password="pass")
+        self.client.force_authenticate(self.user)
+        self.uploads = []
+
+    def _image(self, name="photo.png", size=(800, 600)):
+        import io
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        output = io.BytesIO()
+        Image.new("RGB", size, "red").save(output, format="PNG")
+        return SimpleUploadedFile(name, output.getvalue(), content_type="image/png")
+
+    def _post(self, *files):
+        from unittest.mock import patch
+
+        with patch("app.serializers.process_comment_attachment.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    "/api/comments/",
+                    {
+                        "text": "With files",
+                        "recaptcha_token": "token",
+                        "attachments": files,
+                    },
+                    format="multipart",
+                )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return delay
+
+    def _upload(self, file, resource_type):
+        from PIL import Image
+
+        self.uploads.append(Image.open(file).size)
+        return {"secure_url": "https://res.cloudinary.com/demo/photo.png"}
+
+    def test_post_stages_pending_attachments(self):
+        """Тест что POST сохраняет вложения в ожидании и ставит задачи"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        delay = self._post(self._image(), SimpleUploadedFile("notes.txt", b"hello"))
+
+        attachments = list(CommentAttachment.objects.order_by("id"))
+        self.assertEqual(
+            [(a.media_type, a.status) for a in attachments],
+            [("image", "pending"), ("file", "pending")],
+        )
+        self.assertTrue(
+            all(a.staged_file.storage.exists(a.staged_file.name) for a in attachments)
+        )
+        self.assertEqual(
+            sorted(call.args[0] for call in delay.call_args_list),
+            [a.id for a in attachments],
+        )
+
+        response = self.client.get(f"/api/comments/{attachments[0].comment_id}/")
+        self.assertEqual(response.data["attachments"][0]["status"], "pending")
+
+    def test_attachments_inserted_in_bulk(self):
+        """Тест одной вставки для всех вложений комментария"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        with CaptureQueriesContext(connection) as queries:
+            self._post(
+                self._image("a.png"),
+                self._image("b.png"),
+                SimpleUploadedFile("notes.txt", b"hello"),
+            )
+        inserts = [
+            q
+            for q in queries.captured_queries
+            if q["sql"].startswith('INSERT INTO "app_commentattachment"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(CommentAttachment.objects.count(), 3)
+
+    def test_staging_failure_rolls_back(self):
+        """Тест отката комментария и файлов при ошибке записи"""
+        import os
+        from unittest.mock import patch
+
+        from django.core.files.storage import FileSystemStorage
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        save = FileSystemStorage._save
+
+        def failing_save(storage, name, content):
+            if name.endswith(".txt"):
+                raise OSError("disk full")
+            return save(storage, name, content)
+
+        with patch.object(FileSystemStorage, "_save", failing_save):
+            with self.assertRaises(OSError):
+                self.client.post(
+                    "/api/comments/",
+                    {
+                        "text": "With files",
+                        "recaptcha_token": "token",
+                        "attachments": [
+                            self._image(),
+                            SimpleUploadedFile("notes.txt", b"hello"),
+                        ],
+                    },
+                    format="multipart",
+                )
+
+        self.assertEqual(Comment.objects.count(), 0)
+        staging = os.path.join(self.media_root, "attachments", "staging")
+        self.assertEqual(os.listdir(staging) if os.path.isdir(staging) else [], [])
+
+    def test_invalid_image_rejected(self):
+        """Тест что битое изображение отклоняется сразу"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        response = self.client.post(
+            "/api/comments/",
+            {
+                "text": "Broken",
+                "recaptcha_token": "token",
+                "attachments": [SimpleUploadedFile("broken.png", b"not an image")],
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(CommentAttachment.objects.count(), 0)
+
+    def test_type_sniffed_from_content(self):
+        """Тест что тип файла определяется по сигнатуре, а не по расширению"""
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        png = self._image().read()
+        for name, content in (
+            ("notes.txt", png),
+            ("notes.txt", b"text\0binary"),
+            ("photo.gif", b"hello"),
+        ):
+            response = self.client.post(
+                "/api/comments/",
+                {
+                    "text": "Mismatch",
+                    "recaptcha_token": "token",
+                    "attachments": [SimpleUploadedFile(name, content)],
+                },
+                format="multipart",
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The format is taken from the content
+        self._post(SimpleUploadedFile("photo.jpg", png))
+        self.assertEqual(CommentAttachment.objects.get().media_type, "image")
+
+    def test_huge_dimensions_rejected_from_header(self):
+        """Тест что слишком большое изображение отклоняется по заголовку"""
+        import io
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        output = io.BytesIO()
+        Image.new("1", (8000, 6000)).save(output, format="PNG")
+        response = self.client.post(
+            "/api/comments/",
+            {
+                "text": "Huge",
+                "recaptcha_token": "token",
+                "attachments": [SimpleUploadedFile("huge.png", output.getvalue())],
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("8000x6000", str(response.data))
+
+    def test_upload_peak_memory(self):
+        """Тест что пиковая память на загрузку не зависит от размера файла"""
+        import io
+        import tracemalloc
+
+        from django.core.files.uploadedfile import TemporaryUploadedFile
+        from PIL import Image
+
+        import tempfile
+
+        from app.imaging import render_variants
+        from app.serializers import CommentCreateSerializer
+        from app.storage import LocalStorage
+
+        # Noise doesn't compress: a JPEG of about 3MB
+        output = io.BytesIO()
+        Image.frombytes("RGB", (1600, 1200), os.urandom(1600 * 1200 * 3)).save(
+            output, format="JPEG", quality=95
+        )
+        upload = TemporaryUploadedFile("photo.jpg", "image/jpeg", 0, None)
+        self.addCleanup(upload.close)
+        upload.write(output.getvalue())
+        upload.size = upload.tell()
+        upload.seek(0)
+        del output
+        self.assertGreater(upload.size, 2 * 1024 * 1024)
+
+        storage = LocalStorage(root=os.path.join(self.media_root, "stored"))
+        tracemalloc.start()
+        try:
+            [(file, _)] = CommentCreateSerializer().validate_attachments([upload])
+            with tempfile.TemporaryDirectory() as directory:
+                urls = []
+                for variant in render_variants(file.temporary_file_path(), directory):
+                    with open(variant["path"], "rb") as rendered:
+                        urls.append(storage.save(rendered, "photo.webp"))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertLess(peak, 512 * 1024)
+        with Image.open(storage.path(urls[0].rsplit("/", 1)[1])) as stored:
+            self.assertEqual(stored.size, (320, 240))
+
+    def test_task_resizes_uploads_and_notifies(self):
+        """Тест что задача уменьшает, загружает и сообщает по WebSocket"""
+        from unittest.mock import patch
+
+        from asgiref.sync import async_to_sync
+
+        from app.tasks import process_comment_attachment
+
+        self._post(self._image())
+        attachment = CommentAttachment.objects.get()
+        staged_name = attachment.staged_file.name
+
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"comment_{attachment.comment_id}", channel)
+
+        with patch("app.storage.cloudinary.uploader.upload", side_effect=self._upload):
+            process_comment_attachment.apply(args=[attachment.id])
+
+        self.assertEqual(self.uploads[0], (320, 240))
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.status, "ready")
+        self.assertEqual(attachment.file, "https://res.cloudinary.com/demo/photo.png")
+        self.assertFalse(attachment.staged_file)
+        self.assertFalse(attachment.staged_file.storage.exists(staged_name))
+
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event["type"], "attachment_ready")
+        self.assertEqual(event["attachment"]["id"], attachment.id)
+
+    def test_image_variants_listed_smallest_first(self):
+        """Тест вариантов изображения: размеры, форматы и оригинал"""
+        from unittest.mock import patch
+
+        from app.tasks import process_comment_attachment
+
+        self._post(self._image(size=(2000, 1500)))
+        attachment = CommentAttachment.objects.get()
+        with patch("app.storage.cloudinary.uploader.upload", side_effect=self._upload):
+            process_comment_attachment.apply(args=[attachment.id])
+
+        attachment.refresh_from_db()
+        variants = [
+            (v["name"], v["width"], v["height"], v["format"])
+            for v in attachment.variants
+        ]
+        self.assertEqual(
+            variants,
+            [
+                ("thumbnail", 320, 240, "webp"),
+                ("medium", 1024, 768, "webp"),
+                ("original", 2000, 1500, "png"),
+            ],
+        )
+        self.assertEqual(self.uploads, [(320, 240), (1024, 768), (2000, 1500)])
+        self.assertEqual(attachment.file, attachment.variants[0]["url"])
+
+        response = self.client.get(f"/api/comments/{attachment.comment_id}/")
+        [payload] = response.data["attachments"]
+        self.assertEqual(payload["variants"], attachment.variants)
+
+    def test_small_image_variants_not_enlarged(self):
+        """Тест что маленькое изображение не увеличивается и не дублируется"""
+        import tempfile
+
+        from app.imaging import render_variants
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "small.png")
+            with open(path, "wb") as file:
+                file.write(self._image(size=(200, 100)).read())
+            variants = render_variants(path, directory)
+
+        self.assertEqual(
+            [(v["name"], v["width"], v["height"]) for v in variants],
+            [("thumbnail", 200, 100)],
+        )
+
+    def test_task_marks_failed_after_retries(self):
+        """Тест пометки вложения как неудачного после повторов"""
+        from unittest.mock import patch
+
+        import cloudinary.exceptions
+
+        from app.tasks import process_comment_attachment
+
+        self._post(self._image())
+        attachment = CommentAttachment.objects.get()
+
+        with patch(
+            "app.storage.cloudinary.uploader.upload",
+            side_effect=cloudinary.exceptions.Error("down"),
+        ) as upload:
+            process_comment_attachment.apply(args=[attachment.id])
+
+        self.assertEqual(upload.call_count, 4)
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.status, "failed")
+        self.assertFalse(attachment.staged_file)
+
+    def test_duplicate_upload_reuses_stored_file(self):
+        """Тест повторной загрузки того же файла: без обработки и загрузки"""
+        from unittest.mock import patch
+
+        from app.media import deduplication_stats
+        from app.models import AttachmentBlob
+        from app.tasks import process_comment_attachment
+
+        self._post(self._image())
+        first = CommentAttachment.objects.get()
+        with patch("app.storage.cloudinary.uploader.upload", side_effect=self._upload):
+            process_comment_attachment.apply(args=[first.id])
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.sha256, CommentAttachment.objects.get().sha256)
+
+        delay = self._post(self._image())
+        second = CommentAttachment.objects.exclude(pk=first.pk).get()
+        self.assertEqual(second.status, "ready")
+        self.assertEqual(second.file, blob.file)
+        self.assertFalse(second.staged_file)
+        delay.assert_not_called()
+
+        stats = deduplication_stats()
+        self.assertEqual(stats["reused_uploads"], 1)
+        self.assertEqual(stats["bytes_saved"], blob.size)
+
+        admin = User.objects.create_superuser(username="admin", password="pass")
+        self.client.force_authenticate(admin)
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.data["attachments"]["bytes_saved"], blob.size)
+
+    def test_duplicate_staged_before_first_upload(self):
+        """Тест файла, загруженного дважды до окончания первой обработки"""
+        from unittest.mock import patch
+
+        from app.tasks import process_comment_attachment
+
+        self._post(self._image())
+        self._post(self._image())
+        first, second = CommentAttachment.objects.order_by("id")
+        self.assertEqual(second.status, "pending")
+
+        with patch(
+            "app.storage.cloudinary.uploader.upload", side_effect=self._upload
+        ) as upload:
+            process_comment_attachment.apply(args=[first.id])
+            uploaded = upload.call_count
+            process_comment_attachment.apply(args=[second.id])
+        self.assertEqual(upload.call_count, uploaded)
+        second.refresh_from_db()
+        self.assertEqual(second.status, "ready")
+        self.assertFalse(second.staged_file)
+
+    def test_deleting_pending_attachment_removes_staged_file(self):
+        """Тест удаления загруженного файла вместе с вложением"""
+        self._post(self._image())
+        attachment = CommentAttachment.objects.get()
+        storage, name = attachment.staged_file.storage, attachment.staged_file.name
+
+        attachment.comment.delete()
+        self.assertFalse(storage.exists(name))
+
+
+class AttachmentStorageTests(APITestCase):
+    """Тесты хранилищ вложений"""
+
+    def setUp(self):
+        import tempfile
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.root = os.path.join(media_root.name, "attachments")
+        settings = self.settings(
+            MEDIA_ROOT=media_root.name,
+            ATTACHMENT_STORAGE="app.storage.LocalStorage",
+            ATTACHMENT_X_ACCEL_REDIRECT=None,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def _save(self, content=b"hello", name="notes.txt"):
+        import io
+
+        from app.storage import get_storage
+
+        return get_storage().save(io.BytesIO(content), name)
+
+    def test_local_storage_serves_saved_file(self):
+        """Тест сохранения на диск и отдачи файла"""
+        url = self._save()
+        self.assertRegex(url, r"^/api/attachments/[0-9a-f]{32}\.txt$")
+        # Временные файлы не остаются
+        self.assertEqual(os.listdir(self.root), [url.rsplit("/", 1)[1]])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), b"hello")
+        self.assertIn("immutable", response["Cache-Control"])
+
+    async def test_local_file_streamed_under_asgi(self):
+        """Тест отдачи файла под ASGI асинхронным итератором"""
+        from asgiref.sync import sync_to_async
+
+        url = await sync_to_async(self._save)(b"x" * 200_000)
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response["Content-Length"], "200000")
+        chunks = [chunk async for chunk in response]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks), b"x" * 200_000)
+
+    def test_failed_write_leaves_nothing(self):
+        """Тест что при ошибке записи не остаётся частичных файлов"""
+        from unittest.mock import patch
+
+        from app.exceptions import AttachmentStorageError
+
+        with patch("app.storage.os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(AttachmentStorageError):
+                self._save()
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_x_accel_redirect(self):
+        """Тест отдачи файла через nginx"""
+        url = self._save(name="photo.png")
+        name = url.rsplit("/", 1)[1]
+        with self.settings(ATTACHMENT_X_ACCEL_REDIRECT="/protected/"):
+            response = self.client.get(url)
+        self.assertEqual(response["X-Accel-Redirect"], f"/protected/{name}")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(response.content, b"")
+
+    def test_missing_and_foreign_files(self):
+        """Тест 404 для отсутствующих файлов и других хранилищ"""
+        response = self.client.get(f"/api/attachments/{'0' * 32}.txt")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        url = self._save()
+        with self.settings(ATTACHMENT_STORAGE="app.storage.CloudinaryStorage"):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_pipeline_stores_locally(self):
+        """Тест обработки вложения с локальным хранилищем"""
+        import io
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        from app.tasks import process_comment_attachment
+
+        output = io.BytesIO()
+        Image.new("RGB", (640, 480), "blue").save(output, format="PNG")
+        user = User.objects.create_user(username="author", password="pass")
+        comment = Comment.objects.create(user=user, text="Photo")
+        attachment = CommentAttachment.objects.create(
+            comment=comment,
+            media_type="image",
+            staged_file=SimpleUploadedFile("photo.png", output.getvalue()),
+        )
+
+        process_comment_attachment.apply(args=[attachment.id])
+        attachment.refresh_from_db()
+        self.assertEqual(attachment.status, "ready")
+
+        response = self.client.get(attachment.file)
+        image = Image.open(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(image.size, (320, 240))
 
 
 class PeriodicTaskTests(TestCase):
@@ -461,3 +2536,21 @@ class PeriodicTaskTests(TestCase):
         self.assertEqual(TaskResult.objects.count(), 1)
         self.assertEqual(TaskResult.objects.filter(status="SUCCESS").count(), 1)
         self.assertEqual(TaskResult.objects.filter(status="FAILURE").count(), 0)
+
+    def test_reconcile_comment_counters(self):
+        """Тест исправления рассинхронизированных счётчиков"""
+        from app.tasks import reconcile_comment_counters
+
+        user = User.objects.create_user(username="testuser", password="testpass123")
+        root = Comment.objects.create(user=user, text="Root")
+        child = Comment.objects.create(user=user, text="Child", reply=root)
+        Comment.objects.create(user=user, text="Deep", reply=child)
+
+        self.assertEqual(reconcile_comment_counters(), 0)
+
+        Comment.objects.filter(pk=root.pk).update(reply_count=7, descendant_count=0)
+        self.assertEqual(reconcile_comment_counters(), 1)
+
+        root.refresh_from_db()
+        self.assertEqual(root.reply_count, 1)
+        self.assertEqual(root.descendant_count, 2)
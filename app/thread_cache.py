@@ -0,0 +1,158 @@
+"""
+Whole threads cached as rendered JSON.
+
+The detail view of a top-level comment with default params returns the
+cached bytes as they are. The document is tagged with the thread's content
+generation (``app.caching.thread_content_tag``), which edits, deletes,
+attachment changes and author renames bump. New replies don't bump it:
+they are appended to the cached document in place by ``append_reply`` once
+their transaction commits. A document that can't be patched (stale, locked
+by a concurrent writer, or out of step with the database) is re-rendered by
+the ``render_thread_document`` task, but only for threads that were read
+recently.
+"""
+
+import time
+
+import orjson
+from rest_framework import serializers
+
+from app.caching import (
+    AUTHORS,
+    cached,
+    get_entry,
+    locked,
+    refresh,
+    store,
+    thread_content_tag,
+)
+from app.models import Comment
+from app.renderers import dumps
+from app.serializers import CommentSerializer
+from app.utils import parse_thread_params
+
+DOCUMENT_KEY = "thread_json"
+# Documents are what the detail view returns without params
+LIMITS = parse_thread_params({})
+
+
+def _document_key(thread_id):
+    return f"{DOCUMENT_KEY}:{thread_id}"
+
+
+def _tags(thread_id):
+    return [thread_content_tag(thread_id), AUTHORS]
+
+
+def render(data):
+    return dumps(data)
+
+
+def _render_thread(thread_id):
+    # Raises for replies and unknown ids, so misses are never stored
+    root = Comment.objects.select_related("user").get(pk=thread_id, root__isnull=True)
+    return render(CommentSerializer(root, context=LIMITS).data)
+
+
+def get_document(thread_id):
+    """Cached JSON of the thread, None if ``thread_id`` is not a top-level comment"""
+    try:
+        return cached(
+            _document_key(thread_id),
+            lambda: _render_thread(thread_id),
+            tags=_tags(thread_id),
+        )
+    except Comment.DoesNotExist:
+        return None
+
+
+def rebuild_document(thread_id):
+    """
+    Re-render a cached thread from the database.
+
+    Returns False when another writer holds the document, so the caller can
+    retry.
+    """
+    key = _document_key(thread_id)
+    with locked(key) as acquired:
+        if acquired:
+            try:
+                refresh(key, lambda: _render_thread(thread_id), tags=_tags(thread_id))
+            except Comment.DoesNotExist:
+                pass  # Deleted meanwhile, the stale entry is never served
+    return acquired
+
+
+def _patch(document, reply):
+    """Add ``reply`` to the nested ``document``, None if its parent is missing"""
+    ancestor_ids = reply.ancestor_ids()
+    if document["id"] != ancestor_ids[0]:
+        return None
+
+    ancestors = [document]
+    for ancestor_id in ancestor_ids[1:]:
+        node = ancestors[-1]
+        child = next(
+            (child for child in node["replies"] if child["id"] == ancestor_id),
+            None,
+        )
+        if child is None:
+            # Below the depth or past the replies limit: only counters change
+            if len(node["replies"]) < node["replies_count"]:
+                break
+            return None
+        ancestors.append(child)
+    else:
+        parent = ancestors[-1]
+        if any(child["id"] == reply.id for child in parent["replies"]):
+            return document
+        if len(ancestors) > LIMITS["max_depth"] or (
+            len(parent["replies"]) < parent["replies_count"]
+        ):
+            parent["replies_count"] += 1
+        elif len(parent["replies"]) < LIMITS["replies_limit"]:
+            parent["replies"].append(CommentSerializer(reply, context=LIMITS).data)
+            parent["replies_count"] += 1
+        else:
+            return None  # Cut off from now on, needs a replies_cursor
+
+    created_at = serializers.DateTimeField().to_representation(reply.created_at)
+    for node in ancestors:
+        node["descendant_count"] += 1
+        node["last_activity_at"] = created_at
+    return document
+
+
+def append_reply(reply_id):
+    """Add a committed reply to its cached thread, or schedule a rebuild"""
+    from app.tasks import render_thread_document
+
+    reply = Comment.objects.select_related("user").filter(pk=reply_id).first()
+    if reply is None or reply.root_id is None:
+        return
+    thread_id = reply.root_id
+    key = _document_key(thread_id)
+
+    with locked(key) as acquired:
+        entry, version = get_entry(key, _tags(thread_id))
+        if entry is None:
+            return  # Not read recently
+        if acquired and entry["version"] == version:
+            document = _patch(orjson.loads(entry["value"]), reply)
+            # Replies committed without being patched in leave the counter behind
+            expected = (
+                Comment.objects.filter(pk=thread_id)
+                .values_list("descendant_count", flat=True)
+                .first()
+            )
+            if document is not None and document["descendant_count"] == expected:
+                store(
+                    key,
+                    render(document),
+                    version,
+                    timeout=max(entry["expires"] - time.time(), 0),
+                    delta=entry["delta"],
+                )
+                return
+
+    render_thread_document.delay(thread_id)
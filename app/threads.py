@@ -0,0 +1,211 @@
+from collections import defaultdict
+from functools import reduce
+from itertools import count
+from operator import or_
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    CharField,
+    F,
+    Func,
+    OuterRef,
+    PositiveIntegerField,
+    Q,
+    Subquery,
+    Value,
+    When,
+    prefetch_related_objects,
+)
+from django.db.models.functions import Cast, Concat, Greatest, Substr
+from django.utils import timezone
+
+from app.models import Comment, PATH_END, PATH_STEP
+
+
+def thread_comments(root_id):
+    """All comments of the thread started by ``root_id``, root included"""
+    return Comment.objects.filter(Q(pk=root_id) | Q(root_id=root_id))
+
+
+THREAD_ID_KEY = "comment-thread:{}"
+
+
+def cached_thread_id(pk):
+    """
+    Id of the thread comment ``pk`` belongs to, None if there is no such comment.
+
+    Cached without a TTL: a comment changes threads only when an ancestor is
+    deleted, and detach_comment drops the entries of the whole subtree.
+    """
+    key = THREAD_ID_KEY.format(pk)
+    thread_id = cache.get(key)
+    if thread_id is None:
+        root_id = Comment.objects.filter(pk=pk).values_list("root_id", flat=True)
+        if not root_id:
+            return None
+        thread_id = root_id[0] or pk
+        cache.set(key, thread_id, timeout=None)
+    return thread_id
+
+
+def subtree_q(path):
+    """
+    Filter for the comment at ``path`` and everything below it.
+
+    A plain range rather than LIKE, so it is an index range scan on every
+    backend. ``path`` may also be an expression such as ``OuterRef("path")``.
+    """
+    if isinstance(path, str):
+        upper = path + PATH_END
+    else:
+        upper = Concat(path, Value(PATH_END), output_field=CharField())
+    return Q(path__gte=path, path__lt=upper)
+
+
+def subtree(comment, include_self=False):
+    """Descendants of ``comment`` in depth-first order, one index range scan"""
+    queryset = Comment.objects.filter(subtree_q(comment.path))
+    if not include_self:
+        queryset = queryset.exclude(pk=comment.pk)
+    return queryset.order_by("path")
+
+
+def descendant_count(comment):
+    return subtree(comment).count()
+
+
+def latest_reply(comment):
+    """Most recent comment anywhere below ``comment``"""
+    return subtree(comment).order_by("-created_at", "-id").first()
+
+
+def load_threads(comments, max_depth=None):
+    """
+    Attach the reply subtree to every comment in ``comments``.
+
+    Descendants of top-level comments are fetched by their stored root id,
+    descendants of nested comments by path prefix, in one query. Users and
+    attachments are attached in bulk and the tree is assembled in memory: each
+    node gets a ``thread_replies`` list, so serializing it never touches the
+    database again.
+
+    With ``max_depth`` only that many levels below each comment are loaded.
+    Nodes on the last level get ``thread_replies = None``.
+    """
+    comments = list(comments)
+    if not comments:
+        return comments
+
+    descendants = []
+    if max_depth != 0:
+        depth_bound = {} if max_depth is None else {"depth__lte": max_depth}
+        conditions = [
+            Q(root_id__in=[c.id for c in comments if c.root_id is None], **depth_bound)
+        ]
+        for c in comments:
+            if c.root_id is None:
+                continue
+            if max_depth is not None:
+                depth_bound = {"depth__lte": c.depth + max_depth}
+            conditions.append(subtree_q(c.path) & Q(depth__gt=c.depth, **depth_bound))
+        descendants = list(
+            Comment.objects.filter(reduce(or_, conditions)).order_by("created_at", "id")
+        )
+
+    prefetch_related_objects(comments + descendants, "user", "attachments")
+
+    children = defaultdict(list)
+    for node in descendants:
+        children[node.reply_id].append(node)
+
+    level = comments
+    for relative_depth in count():
+        next_level = []
+        for node in level:
+            if relative_depth == max_depth:
+                node.thread_replies = None
+            else:
+                node.thread_replies = children.get(node.id, [])
+                next_level += node.thread_replies
+        if not next_level:
+            break
+        level = next_level
+
+    return comments
+
+
+def subtree_aggregate(function, field, *conditions, exclude=None, **filters):
+    """Correlated subquery aggregating over comments matched by the filters"""
+    comments = Comment.objects.filter(*conditions, **filters)
+    if exclude is not None:
+        comments = comments.exclude(exclude)
+    return Subquery(
+        comments.order_by()
+        .annotate(value=Func(F(field), function=function))
+        .values("value")
+    )
+
+
+def _decrement(field, amount):
+    # Counters may have drifted; never push them below zero
+    return Greatest(F(field) - amount, Value(0), output_field=PositiveIntegerField())
+
+
+def detach_comment(comment):
+    """
+    Take ``comment`` out of its thread before it is deleted.
+
+    Its replies lose their parent and become roots of their own threads, so the
+    path prefix, root id and depth of every node below it are rewritten with a
+    single UPDATE, which also moves their ``updated_at`` for delta sync. The
+    parent loses a reply and every ancestor loses the comment together with
+    its whole subtree, and gets the ``last_activity_at`` of what remains.
+
+    Returns the ids of the comments moved to new threads.
+    """
+    comment = Comment.objects.get(pk=comment.pk)
+    path, depth = comment.path, comment.depth
+    cut = len(path) + 1
+
+    if comment.reply_id is not None:
+        Comment.objects.filter(pk__in=comment.ancestor_ids()).update(
+            reply_count=Case(
+                When(pk=comment.reply_id, then=_decrement("reply_count", 1)),
+                default=F("reply_count"),
+                output_field=PositiveIntegerField(),
+            ),
+            descendant_count=_decrement(
+                "descendant_count", comment.descendant_count + 1
+            ),
+            last_activity_at=subtree_aggregate(
+                "MAX",
+                "created_at",
+                subtree_q(OuterRef("path")),
+                exclude=subtree_q(path),
+            ),
+        )
+
+    moved = list(Comment.objects.filter(subtree_q(path)).values_list("pk", flat=True))
+    keys = [THREAD_ID_KEY.format(pk) for pk in moved]
+    # Again on commit, in case a reader cached the old thread in between
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+    # Replies of the comment become top-level in the same statement, so no
+    # row is ever a reply without a root (comment_thread_position)
+    direct = When(reply=comment.pk, then=None)
+    Comment.objects.filter(subtree_q(path)).exclude(pk=comment.pk).update(
+        path=Substr("path", cut),
+        depth=F("depth") - depth - 1,
+        root_id=Case(
+            direct,
+            default=Cast(Substr("path", cut, PATH_STEP), BigIntegerField()),
+            output_field=BigIntegerField(),
+        ),
+        reply_id=Case(direct, default=F("reply_id"), output_field=BigIntegerField()),
+        updated_at=timezone.now(),
+    )
+    return [pk for pk in moved if pk != comment.pk]
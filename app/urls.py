@@ -1,21 +1,45 @@
-from django.urls import path
+from django.urls import path, re_path
 
 from .views import (
     CommentListCreateAPIView,
     CommentDetailAPIView,
+    CommentRepliesAPIView,
     CommentPreviewAPIView,
+    CommentChangesAPIView,
+    CommentThreadStreamAPIView,
+    CommentExportAPIView,
     RegistrationView,
     user_me,
     comment_text_preview,
     health_check,
+    metrics,
+    attachment_file,
 )
 
 urlpatterns = [
     path("comments/", CommentListCreateAPIView.as_view(), name="comment-list-create"),
     path("comments/preview/", CommentPreviewAPIView.as_view(), name="comment-preview"),
+    path("comments/changes/", CommentChangesAPIView.as_view(), name="comment-changes"),
     path("comments/<int:pk>/", CommentDetailAPIView.as_view(), name="comment-detail"),
+    path(
+        "comments/<int:pk>/replies/",
+        CommentRepliesAPIView.as_view(),
+        name="comment-replies",
+    ),
+    path(
+        "comments/<int:pk>/stream/",
+        CommentThreadStreamAPIView.as_view(),
+        name="comment-thread-stream",
+    ),
+    path("comments/export/", CommentExportAPIView.as_view(), name="comment-export"),
     path("comments/preview-text/", comment_text_preview, name="comment-text-preview"),
     path("user/me/", user_me, name="user-me"),
     path("user/register/", RegistrationView.as_view(), name="user-register"),
     path("health/", health_check, name="health_check"),
+    path("metrics/", metrics, name="metrics"),
+    re_path(
+        r"^attachments/(?P<name>[0-9a-f]{32}\.[a-z0-9]+)$",
+        attachment_file,
+        name="attachment-file",
+    ),
 ]
@@ -1,7 +1,232 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import datetime
+import json
+from functools import reduce
+from operator import attrgetter, or_
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 25
     page_size_query_param = "page_size"
     max_page_size = 100
+
+
+class PrerenderedJSONResponse(Response):
+    """
+    Response with a body that is already rendered JSON, sent as it is.
+
+    ``data`` is decoded from the body on access, for callers such as tests.
+    """
+
+    def __init__(self, content, **kwargs):
+        self.prerendered = content
+        super().__init__(**kwargs)
+
+    @property
+    def data(self):
+        return json.loads(self.prerendered)
+
+    @data.setter
+    def data(self, value):
+        # Response.__init__ assigns the (absent) data
+        pass
+
+    @property
+    def rendered_content(self):
+        self["Content-Type"] = "application/json"
+        return self.prerendered
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over the queryset's ordering with ``id`` as a tie-breaker.
+
+    The cursor stores the ordering values of the last row of a page, and the
+    next page is fetched with a ``WHERE (a, id) > (x, y)``-style filter, so no
+    page needs COUNT(*) or OFFSET and page N costs the same as page 1.
+    Related-field orderings like ``user__username`` are supported.
+    """
+
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    default_ordering = ("-created_at",)
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+
+        position = self.decode_cursor(request, queryset)
+        if position is not None:
+            queryset = queryset.filter(self.position_filter(position))
+
+        rows = list(queryset.order_by(*self.ordering)[: self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[: self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def get_ordering(self, queryset):
+        ordering = [
+            field
+            for field in (queryset.query.order_by or self.default_ordering)
+            if field.lstrip("-") not in ("id", "pk")
+        ]
+        tie_breaker = "-id" if ordering and ordering[0].startswith("-") else "id"
+        return ordering + [tie_breaker]
+
+    def position_filter(self, position):
+        """Rows strictly after ``position`` in the current ordering"""
+        conditions = []
+        for i, field in enumerate(self.ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            equal = {
+                prev.lstrip("-"): value
+                for prev, value in zip(self.ordering[:i], position)
+            }
+            conditions.append(Q(**equal, **{f"{name}__{lookup}": position[i]}))
+        return reduce(or_, conditions)
+
+    def position_from_instance(self, instance):
+        return [
+            attrgetter(field.lstrip("-").replace("__", "."))(instance)
+            for field in self.ordering
+        ]
+
+    def encode_cursor(self, instance):
+        position = [
+            value.isoformat() if hasattr(value, "isoformat") else value
+            for value in self.position_from_instance(instance)
+        ]
+        payload = json.dumps({"o": self.ordering, "p": position})
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def ordering_field(self, queryset, field):
+        """Model field or annotation output field of an ordering entry"""
+        name = field.lstrip("-")
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        opts = queryset.model._meta
+        for part in name.split("__"):
+            model_field = opts.get_field(part)
+            if model_field.is_relation:
+                opts = model_field.related_model._meta
+        return model_field
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            ordering, position = payload["o"], payload["p"]
+            if ordering != self.ordering or len(position) != len(ordering):
+                raise ValueError
+            position = [
+                self.ordering_field(queryset, field).to_python(value)
+                for field, value in zip(ordering, position)
+            ]
+            for value in position:
+                if value is None or (
+                    isinstance(value, datetime.datetime) and timezone.is_naive(value)
+                ):
+                    raise ValueError
+        except (
+            binascii.Error,
+            ValueError,
+            TypeError,
+            KeyError,
+            DjangoValidationError,
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class ReplyPagination(KeysetPagination):
+    """Replies of one comment, oldest first, same order as nested ``replies``"""
+
+    page_size = 10
+    ordering = ["created_at", "id"]
+
+    def get_ordering(self, queryset):
+        return self.ordering
+
+
+class PreviewPagination(KeysetPagination):
+    """Top-level comment previews, newest first"""
+
+    ordering = ["-created_at", "-id"]
+
+    def get_ordering(self, queryset):
+        return self.ordering
+
+
+# (default, maximum) of each nested output param; replies past them are
+# paged through the comment-replies endpoint
+THREAD_PARAMS = {"depth": (3, 10), "replies_limit": (10, 100)}
+
+
+def parse_thread_params(query_params):
+    """
+    Read ``depth`` and ``replies_limit`` query params for nested comment output.
+
+    ``depth`` limits how many levels of replies are included below each
+    serialized comment, ``replies_limit`` how many replies per comment.
+    Missing params get the defaults in ``THREAD_PARAMS`` and larger values
+    are capped at its maximums.
+    """
+    params = {}
+    for name, key in (("depth", "max_depth"), ("replies_limit", "replies_limit")):
+        default, maximum = THREAD_PARAMS[name]
+        raw = query_params.get(name)
+        if raw in (None, ""):
+            params[key] = default
+            continue
+        try:
+            value = int(raw)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise ValidationError({name: "Must be a non-negative integer."})
+        params[key] = min(value, maximum)
+    return params
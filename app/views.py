@@ -1,20 +1,48 @@
+import mimetypes
+import os
+
 from rest_framework import generics, permissions, filters
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.parsers import MultiPartParser, FormParser
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
+from app.caching import AUTHORS, PREVIEW_LIST, cached
+from app.conditional import comment_detail_condition, comment_list_condition
+from app.media import deduplication_stats
 from app.models import Comment
+from app.parsers import MessagePackParser, ORJSONParser
+from app.renderers import ORJSONRenderer
+from app.search import CommentSearchFilter
+from app.storage import CHUNK_SIZE, LocalStorage, get_storage
+from app.streaming import stream_array, stream_thread, streaming_json_response
+from app.sync import changes
+from app.thread_cache import get_document
+from app.threads import cached_thread_id
 from app.serializers import (
+    CommentChangeSerializer,
     CommentSerializer,
     CommentCreateSerializer,
     UserSerializer,
     CommentPreviewSerializer,
     RegistrationSerializer,
 )
-from app.utils import StandardResultsSetPagination
+from app.utils import (
+    KeysetPagination,
+    PrerenderedJSONResponse,
+    PreviewPagination,
+    ReplyPagination,
+    StandardResultsSetPagination,
+    parse_thread_params,
+)
 
 
 class RegistrationView(generics.CreateAPIView):
@@ -23,38 +51,73 @@ class RegistrationView(generics.CreateAPIView):
     permission_classes = []
 
 
-class CommentListCreateAPIView(generics.ListCreateAPIView):
+class ThreadParamsMixin:
+    """Pass ?depth= and ?replies_limit= to the nested comment serializer"""
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request is not None and self.request.method == "GET":
+            context.update(parse_thread_params(self.request.query_params))
+        return context
+
+
+@comment_list_condition
+class CommentListCreateAPIView(ThreadParamsMixin, generics.ListCreateAPIView):
     """
     API view to list all top-level comments (no parent) and create new comments.
     GET: Returns all comments that are not replies
+         (?pagination=cursor or ?cursor=... switches to keyset pagination,
+         ?search=... searches text, username and email by relevance;
+         ETag / Last-Modified, 304 for matching conditional requests)
     POST: Create a new comment
     """
 
-    queryset = Comment.objects.filter(reply__isnull=True).order_by("-created_at")
+    queryset = (
+        Comment.objects.filter(reply__isnull=True)
+        .select_related("user")
+        .prefetch_related("attachments")
+        .order_by("-created_at")
+    )
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
-    parser_classes = (MultiPartParser, FormParser, JSONParser)
+    parser_classes = (MultiPartParser, FormParser, ORJSONParser, MessagePackParser)
     pagination_class = StandardResultsSetPagination
-    filter_backends = [filters.OrderingFilter, filters.SearchFilter]
-    ordering_fields = ["created_at", "user__username", "user__email"]
+    filter_backends = [filters.OrderingFilter, CommentSearchFilter]
+    ordering_fields = [
+        "created_at",
+        "last_activity_at",
+        "user__username",
+        "user__email",
+    ]
     ordering = ["-created_at"]
     search_fields = ["user__username", "user__email"]
 
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            params = getattr(self.request, "query_params", {})
+            if params.get("pagination") == "cursor" or "cursor" in params:
+                self._paginator = KeysetPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def get_serializer_class(self):
         if self.request.method == "POST":
             return CommentCreateSerializer
         return CommentSerializer
 
 
-class CommentDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
+@comment_detail_condition
+class CommentDetailAPIView(ThreadParamsMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     API view to retrieve, update, or delete a specific comment.
-    GET: Retrieve a comment by ID
+    GET: Retrieve a comment by ID (ETag / Last-Modified, 304 when unchanged)
     PUT/PATCH: Update a comment
     DELETE: Delete a comment
     """
 
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related("user")
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
@@ -63,29 +126,159 @@ class CommentDetailAPIView(generics.RetrieveUpdateDestroyAPIView):
             return CommentCreateSerializer
         return CommentSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        # Whole threads in JSON are served pre-rendered from app.thread_cache
+        params = request.query_params
+        if (
+            request.accepted_renderer.format != "json"
+            or "depth" in params
+            or "replies_limit" in params
+            # Replies and unknown ids never reach the document cache
+            or cached_thread_id(kwargs["pk"]) != kwargs["pk"]
+        ):
+            return super().retrieve(request, *args, **kwargs)
+
+        body = get_document(kwargs["pk"])
+        if body is None:
+            return super().retrieve(request, *args, **kwargs)
+        return PrerenderedJSONResponse(body)
+
+
+class CommentRepliesAPIView(ThreadParamsMixin, generics.ListAPIView):
+    """
+    API view to page through the direct replies of a comment.
+    GET: Returns replies oldest first with cursor pagination; accepts the
+         replies_cursor of a truncated comment as ?cursor=
+    """
+
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    serializer_class = CommentSerializer
+    pagination_class = ReplyPagination
+
+    def get_queryset(self):
+        parent = get_object_or_404(Comment, pk=self.kwargs["pk"])
+        return (
+            parent.replies.select_related("user")
+            .prefetch_related("attachments")
+            .order_by("created_at", "id")
+        )
+
 
 class CommentPreviewAPIView(generics.ListAPIView):
     """
-    API view to list all top-level comments (no parent) with Redis caching.
-    GET: Returns all comments that are not replies
-    Cache TTL: 5 minutes
+    API view to list top-level comments (no parent) as short excerpts with Redis caching.
+    GET: Returns a page of comments that are not replies, newest first
+         (?cursor=... for the next page, ?page_size=... up to 100)
+    Every page is cached separately until a top-level comment changes and is
+    recomputed by one worker at a time (app.caching)
     """
 
-    queryset = Comment.objects.filter(reply__isnull=True).order_by("-created_at")
+    queryset = Comment.objects.filter(reply__isnull=True).only(
+        "id", "text", "created_at"
+    )
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     serializer_class = CommentPreviewSerializer
+    pagination_class = PreviewPagination
+
+    def get_cache_key(self, request):
+        paginator = self.paginator
+        page_size = paginator.get_page_size(request)
+        cursor = request.query_params.get(paginator.cursor_query_param, "")
+        return f"comment_preview_list:{page_size}:{cursor}"
 
     def list(self, request, *args, **kwargs):
-        cache_key = "comment_preview_list"
+        data = cached(
+            self.get_cache_key(request),
+            lambda: super(CommentPreviewAPIView, self)
+            .list(request, *args, **kwargs)
+            .data,
+            tags=[PREVIEW_LIST, AUTHORS],
+        )
+        return Response(data)
+
+
+class CommentChangesAPIView(generics.GenericAPIView):
+    """
+    API view for delta sync: comments changed or deleted since a cursor.
+    GET: Returns {"changed": [...], "deleted": [ids], "cursor": ..., "has_more": ...}
+         oldest change first (?since=<cursor> from the previous response,
+         ?thread=<id> for one thread, where replies moved out of it by a
+         delete are reported as deleted, ?limit=... up to 500).
+         Without ?since returns every comment; 410 when the cursor expired
+    """
+
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    serializer_class = CommentChangeSerializer
+    default_limit = 100
+    max_limit = 500
 
-        cached_data = cache.get(cache_key)
-        if cached_data is not None:
-            return Response(cached_data)
+    def get_limit(self, params):
+        try:
+            limit = int(params["limit"])
+        except (KeyError, ValueError):
+            return self.default_limit
+        return min(max(limit, 1), self.max_limit)
 
-        response = super().list(request, *args, **kwargs)
-        cache.set(cache_key, response.data, timeout=300)
-        return response
+    def get(self, request, *args, **kwargs):
+        params = request.query_params
+        thread_id = params.get("thread")
+        if thread_id is not None and not thread_id.isdigit():
+            raise ValidationError({"thread": "A comment id is required."})
+
+        changed, deleted, cursor, has_more = changes(
+            cursor=params.get("since") or None,
+            thread_id=thread_id and int(thread_id),
+            limit=self.get_limit(params),
+        )
+        return Response(
+            {
+                "changed": self.get_serializer(changed, many=True).data,
+                "deleted": deleted,
+                "cursor": cursor,
+                "has_more": has_more,
+            }
+        )
+
+
+class CommentThreadStreamAPIView(generics.GenericAPIView):
+    """
+    API view to stream a comment with all of its replies nested.
+    GET: Streams the JSON without building it in memory (app.streaming),
+         for threads too large for the detail view
+    """
+
+    queryset = Comment.objects.all()
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    # Streamed as JSON only
+    renderer_classes = [ORJSONRenderer]
+
+    def get(self, request, *args, **kwargs):
+        return streaming_json_response(request, stream_thread(self.get_object()))
+
+
+class CommentExportAPIView(generics.GenericAPIView):
+    """
+    API view to export every comment as a flat JSON array, oldest first.
+    GET: Streams the array without building it in memory (app.streaming).
+         Admins only: it reads the whole table
+    """
+
+    queryset = Comment.objects.order_by("id")
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAdminUser]
+    # Streamed as JSON only
+    renderer_classes = [ORJSONRenderer]
+
+    def get(self, request, *args, **kwargs):
+        return streaming_json_response(
+            request,
+            stream_array(self.get_queryset()),
+            headers={"Content-Disposition": 'attachment; filename="comments.json"'},
+        )
 
 
 @api_view(["GET"])
@@ -108,6 +301,60 @@ def comment_text_preview(request):
     return Response(serializer.errors, status=400)
 
 
+@api_view(["GET"])
+@permission_classes([permissions.IsAdminUser])
+def metrics(request):
+    """Cache hit rates per tier, summed over all workers, and upload savings"""
+    stats = getattr(cache, "stats", None)
+    return Response(
+        {
+            "cache": stats() if stats else None,
+            "attachments": deduplication_stats(),
+        }
+    )
+
+
+async def _file_chunks(file):
+    try:
+        while chunk := await sync_to_async(file.read, thread_sensitive=False)(
+            CHUNK_SIZE
+        ):
+            yield chunk
+    finally:
+        file.close()
+
+
+def attachment_file(request, name):
+    """
+    Serve a file of app.storage.LocalStorage: through nginx with
+    X-Accel-Redirect when configured, otherwise from Django, a chunk at a
+    time (asynchronously under ASGI, where FileResponse would read the whole
+    file into memory first)
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        raise Http404
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if settings.ATTACHMENT_X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = settings.ATTACHMENT_X_ACCEL_REDIRECT + name
+    else:
+        try:
+            file = open(storage.path(name), "rb")
+        except FileNotFoundError:
+            raise Http404
+        if isinstance(request, ASGIRequest):
+            response = StreamingHttpResponse(
+                _file_chunks(file), content_type=content_type
+            )
+            response["Content-Length"] = os.fstat(file.fileno()).st_size
+        else:
+            response = FileResponse(file)
+    # Stored names are unique and never reused
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 @api_view(["GET"])
 def health_check(request):
     return Response({"status": "ok"})
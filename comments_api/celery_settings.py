@@ -1,3 +1,4 @@
+from celery.schedules import crontab
 from django.conf import settings
 
 CELERY = {
@@ -6,4 +7,14 @@ CELERY = {
     "result_extended": True,
     "beat_scheduler": settings.CELERY_BEAT_SCHEDULER,
     "result_backend": settings.CELERY_RESULT_BACKEND,
+    "beat_schedule": {
+        "reconcile-comment-counters": {
+            "task": "app.tasks.reconcile_comment_counters",
+            "schedule": crontab(minute=30),
+        },
+        "purge-comment-tombstones": {
+            "task": "app.tasks.purge_comment_tombstones",
+            "schedule": crontab(hour=4, minute=0),
+        },
+    },
 }
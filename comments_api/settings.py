@@ -47,6 +47,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
 ]
 
 MIDDLEWARE = [
@@ -140,6 +141,24 @@ USE_TZ = True
 STATIC_URL = "static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
+# Uploaded attachments are staged here until the worker has processed them;
+# the web and worker containers share it as a volume
+MEDIA_URL = "media/"
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", os.path.join(BASE_DIR, "media"))
+# Uploads above this are received into temporary files rather than memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024
+
+# Where processed attachments go: app.storage.CloudinaryStorage or
+# app.storage.LocalStorage (files under ATTACHMENT_STORAGE_ROOT, default
+# MEDIA_ROOT/attachments, served at ATTACHMENT_STORAGE_URL)
+ATTACHMENT_STORAGE = os.getenv("ATTACHMENT_STORAGE", "app.storage.CloudinaryStorage")
+ATTACHMENT_STORAGE_ROOT = os.getenv("ATTACHMENT_STORAGE_ROOT")
+ATTACHMENT_STORAGE_URL = os.getenv("ATTACHMENT_STORAGE_URL", "/api/attachments/")
+# nginx internal location mapped to ATTACHMENT_STORAGE_ROOT
+# ("/protected-attachments/" in vue_ui/nginx.conf); when set, local files are
+# sent by nginx instead of Django
+ATTACHMENT_X_ACCEL_REDIRECT = os.getenv("ATTACHMENT_X_ACCEL_REDIRECT")
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -198,6 +217,13 @@ CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 
 RECAPTCHA_PUBLIC_KEY = os.getenv("RECAPTCHA_PUBLIC_KEY")
 RECAPTCHA_PRIVATE_KEY = os.getenv("RECAPTCHA_PRIVATE_KEY")
+RECAPTCHA_VERIFIER = os.getenv(
+    "RECAPTCHA_VERIFIER", "app.recaptcha.GoogleRecaptchaVerifier"
+)
+RECAPTCHA_VERIFY_URL = os.getenv(
+    "RECAPTCHA_VERIFY_URL", "https://www.google.com/recaptcha/api/siteverify"
+)
+RECAPTCHA_TIMEOUT = float(os.getenv("RECAPTCHA_TIMEOUT", 10))
 
 cloudinary.config(
     cloud_name=os.getenv("CLOUDINARY_CLOUD_NAME"),
@@ -214,9 +240,15 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "BACKEND": "app.cache_backends.TwoTierCache",
         "LOCATION": os.getenv("REDIS_CACHE_URL", "redis://127.0.0.1:6379/1"),
-        "OPTIONS": {},
+        "OPTIONS": {
+            "L1_MAX_ENTRIES": int(os.getenv("CACHE_L1_MAX_ENTRIES", 1000)),
+            "L1_TIMEOUT": int(os.getenv("CACHE_L1_TIMEOUT", 5)),
+            # Tag generations, last-modified times and locks of app.caching:
+            # keys and ETags are built from them, so they are never stale
+            "L1_EXCLUDE": ["generation:*", "modified:*", "*:lock"],
+        },
         "KEY_PREFIX": "comments_api",
         "TIMEOUT": 300,
     }
@@ -228,6 +260,17 @@ REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
         "rest_framework_simplejwt.authentication.JWTAuthentication",
     ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "app.renderers.ORJSONRenderer",
+        "app.renderers.MessagePackRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "app.parsers.ORJSONParser",
+        "app.parsers.MessagePackParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
 }
 
 SIMPLE_JWT = {
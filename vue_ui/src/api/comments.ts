@@ -1,5 +1,5 @@
 import { api } from '../utils/api'
-import type { Comment, CommentsResponse, CommentParams } from '../types/api'
+import type { Comment, CommentsResponse, CommentParams, RepliesResponse } from '../types/api'
 
 export const commentsApi = {
   getAll: (params: CommentParams = {}) => {
@@ -15,6 +15,13 @@ export const commentsApi = {
     return api.get<Comment>(`/comments/${id}/`)
   },
 
+  getReplies: (id: number, cursor?: string | null) => {
+    const queryParams = new URLSearchParams()
+    if (cursor) queryParams.append('cursor', cursor)
+
+    return api.get<RepliesResponse>(`/comments/${id}/replies/?${queryParams.toString()}`)
+  },
+
   create: (formData: FormData) => {
     return api.post<Comment>('/comments/', formData)
   },
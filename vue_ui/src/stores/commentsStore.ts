@@ -2,7 +2,7 @@ import { defineStore } from 'pinia'
 import { ref } from 'vue'
 import { useAuthStore } from './authStore'
 import { commentsApi } from '../api/comments'
-import type { Comment } from '../types/comments'
+import type { Attachment, Comment } from '../types/comments'
 
 const API_HOST = import.meta.env.VITE_API_HOST
 
@@ -93,6 +93,44 @@ export const useCommentsStore = defineStore('comments', () => {
     }
   }
 
+  const findComment = (list: Comment[], id: number): Comment | null => {
+    for (const comment of list) {
+      if (comment.id === id) return comment
+      const found = findComment(comment.replies ?? [], id)
+      if (found) return found
+    }
+    return null
+  }
+
+  const updateAttachment = (attachment: Attachment) => {
+    const roots = currentComment.value ? [currentComment.value, ...comments.value] : comments.value
+    const comment = attachment.comment !== undefined ? findComment(roots, attachment.comment) : null
+    const index = comment?.attachments?.findIndex(a => a.id === attachment.id) ?? -1
+    if (comment?.attachments && index !== -1) {
+      comment.attachments[index] = attachment
+    }
+  }
+
+  // Replies past the depth or replies limit of the response, one page at a time
+  const hasMoreReplies = (comment: Comment) =>
+    comment.replies_cursor != null || (!comment.replies?.length && (comment.replies_count ?? 0) > 0)
+
+  const loadMoreReplies = async (comment: Comment) => {
+    try {
+      const response = await commentsApi.getReplies(comment.id, comment.replies_cursor)
+      const replies = comment.replies ?? []
+      for (const reply of response.results) {
+        if (!replies.find(r => r.id === reply.id)) replies.push(reply)
+      }
+      comment.replies = replies
+      comment.replies_cursor = response.next
+        ? new URL(response.next, window.location.origin).searchParams.get('cursor')
+        : null
+    } catch (err: any) {
+      error.value = err.message
+    }
+  }
+
   // WebSocket connection for real-time replies
   const connectWebSocket = (commentId: number) => {
     if (socket.value) {
@@ -152,6 +190,11 @@ export const useCommentsStore = defineStore('comments', () => {
             }
         }
       }
+
+      // An attachment was processed (or failed): replace the pending one
+      if (data.type === 'attachment_ready' || data.type === 'attachment_failed') {
+        updateAttachment(data.data)
+      }
     }
 
     socket.value.onerror = (err) => {
@@ -182,6 +225,8 @@ export const useCommentsStore = defineStore('comments', () => {
     fetchComments,
     fetchCommentDetail,
     addComment,
+    hasMoreReplies,
+    loadMoreReplies,
     connectWebSocket,
     disconnectWebSocket
   }
@@ -9,6 +9,11 @@ export interface CommentsResponse {
   results: Comment[]
 }
 
+export interface RepliesResponse {
+  next: string | null
+  results: Comment[]
+}
+
 export interface CommentParams {
   page?: number
   ordering?: string
@@ -1,9 +1,22 @@
 import type { User } from './auth'
 
+export interface AttachmentVariant {
+  name: string
+  url: string
+  width: number
+  height: number
+  format: string
+}
+
 export interface Attachment {
   id: number
+  comment?: number
+  // Empty until the attachment is processed (status "ready")
   file: string
   media_type: string
+  status: 'pending' | 'ready' | 'failed'
+  // Images: resized copies and the original, smallest first
+  variants?: AttachmentVariant[]
 }
 
 export interface Comment {
@@ -14,5 +27,9 @@ export interface Comment {
   updated_at: string
   reply: number | null
   replies?: Comment[]
+  // All direct replies, also those cut off from `replies`
+  replies_count?: number
+  // Where the replies endpoint continues after the last included reply
+  replies_cursor?: string | null
   attachments?: Attachment[]
 }